@@ -1,112 +1,73 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel
 import os
-from services.downloader import download_instagram_video
-from services.gemini import analyze_video, get_cached_recipe
-from services.firebase_service import update_recipe_rating, send_push_notification, add_recipe_to_user
+import asyncio
+import logging
+from services.gemini import get_cached_recipe, forget_cached_recipe, warm_up_gemini
+from services.firebase_service import update_recipe_rating, add_recipe_to_user, warm_up_firebase
 from models import Recipe, AnalyzeRequest
+from worker import process_video_background, REDIS_HOST
 
 from fastapi.staticfiles import StaticFiles
 
+# Services log through `logging`, show their INFO messages in the API process too.
+# The dramatiq CLI configures logging for worker processes itself.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
 app = FastAPI()
 
 # Mount static directory for generated images
 os.makedirs("static", exist_ok=True)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+@app.on_event("startup")
+async def warm_up_clients():
+    # Pay for the first gRPC channel / TLS handshakes at boot instead of on the first request.
+    # Both helpers swallow their own errors, a failed warm-up never blocks startup.
+    await asyncio.to_thread(warm_up_firebase)
+    await asyncio.to_thread(warm_up_gemini)
+
 class ProcessingResponse(BaseModel):
     status: str
     message: str
     recipe_id: str | None = None
+    recipe: Recipe | None = None
 
-def process_video_background(url: str, language: str, fcm_token: str | None, user_id: str | None):
-    """
-    Background task to process video and send push notification.
-    """
-    video_path = None
-    try:
-        print(f"Starting background processing for: {url}")
-        
-        # Check cache first
-        has_cache = get_cached_recipe(url, language) or \
-                   (language != "en" and get_cached_recipe(url, "en"))
-
-        recipe = None
-        if not has_cache:
-            # 1. Download Video
-            print(f"Downloading video from: {url}")
-            video_path, metadata = download_instagram_video(url)
-            print(f"Video downloaded to: {video_path}")
-            print(f"Metadata extracted: {metadata}")
-        else:
-            print("Cache found, skipping download.")
-            metadata = {}
-
-        # 2. Analyze with Gemini (this saves to Firestore internally)
-        print("Analyzing with Gemini...")
-        recipe = analyze_video(video_path, url, language, author_name=metadata.get("author_name"))
-        
-        
-        print(f"Background processing complete. Recipe ID: {recipe.id}")
-        
-        # 3. Save to User (if user_id provided)
-        if user_id and recipe and recipe.id:
-            add_recipe_to_user(user_id, recipe.id)
-
-        # 4. Send Push Notification
-        if fcm_token and recipe:
-            send_push_notification(
-                token=fcm_token,
-                title="Recipe Ready! 🍳",
-                body=f"Your recipe '{recipe.title}' is ready to cook.",
-                data={
-                    "recipe_id": recipe.id,
-                    "type": "recipe_ready"
-                }
-            )
-            
-    except Exception as e:
-        print(f"Background processing failed: {e}")
-        # Send error notification
-        if fcm_token:
-            send_push_notification(
-                token=fcm_token,
-                title="Processing Failed 😕",
-                body="We couldn't extract a recipe from that video. Please try another one.",
-                data={
-                    "type": "error",
-                    "error": str(e)
-                }
-            )
-    finally:
-        if video_path and os.path.exists(video_path):
-            try:
-                os.remove(video_path)
-                print("Cleaned up temporary video file.")
-            except:
-                pass
-
+# The handlers below call the blocking Firestore / Gemini / Redis clients, so they are plain
+# `def`: FastAPI runs them in its threadpool instead of stalling the event loop.
 @app.post("/analyze", response_model=ProcessingResponse)
-async def analyze_recipe(request: AnalyzeRequest, background_tasks: BackgroundTasks):
-    # Check if we have a direct cache hit to return immediately?
-    # Actually, for "processing screen" flow, we might WANT to show it even if fast?
-    # But if it's cached, might be nice to return immediately.
-    # However, to keep clients simple, let's ALWAYS return "processing" 
-    # and let the push notification (or polling) handle it?
-    # OR: If cached, return status="completed" and the recipe_id?
-    
-    # Let's try to be smart. If cached, we can return fast.
-    # But currently verify_video downloads if not cached. 
-    # Let's just offload EVERYTHING to background to match the requested UI flow.
+def analyze_recipe(request: AnalyzeRequest, background_tasks: BackgroundTasks):
+    # Exact cache hit: return the recipe directly, no processing screen or push needed.
+    # Translating from a cached base still goes through the background flow.
+    cached = get_cached_recipe(request.url, request.language, allow_translation=False)
+    if cached:
+        if request.user_id and cached.id:
+            add_recipe_to_user(request.user_id, cached.id)
+        return ProcessingResponse(
+            status="completed",
+            message="Recipe found in cache.",
+            recipe_id=cached.id,
+            recipe=cached
+        )
+
+    # Cache miss: offload everything to background to match the requested UI flow.
     # The user wants "Processing View" -> "Push Notification".
-    
-    background_tasks.add_task(
-        process_video_background, 
-        request.url, 
-        request.language, 
-        request.fcm_token,
-        request.user_id
-    )
+    if REDIS_HOST:
+        # Hand off to the Dramatiq workers; the API process only enqueues.
+        process_video_background.send(
+            request.url,
+            request.language,
+            request.fcm_token,
+            request.user_id
+        )
+    else:
+        background_tasks.add_task(
+            process_video_background.fn, 
+            request.url, 
+            request.language, 
+            request.fcm_token,
+            request.user_id
+        )
     
     return ProcessingResponse(
         status="processing",
@@ -118,15 +79,17 @@ class RateRequest(BaseModel):
     rating: int
 
 @app.post("/rate")
-async def rate_recipe(request: RateRequest):
+def rate_recipe(request: RateRequest):
     print(f"Rating recipe {request.recipe_id} with {request.rating}")
     result = update_recipe_rating(request.recipe_id, request.rating)
     if not result:
         raise HTTPException(status_code=400, detail="Failed to update rating")
+    # Cached copies carry the old rating
+    forget_cached_recipe(result['id'])
     return result
 
 @app.post("/translate", response_model=Recipe)
-async def translate_recipe_endpoint(request: AnalyzeRequest):
+def translate_recipe_endpoint(request: AnalyzeRequest):
     """
     Translates an existing recipe to the target language.
     """
@@ -141,7 +104,7 @@ async def translate_recipe_endpoint(request: AnalyzeRequest):
     raise HTTPException(status_code=404, detail="Recipe not found. Please analyze it first.")
 
 @app.get("/recipes/{recipe_id}", response_model=Recipe)
-async def get_recipe_by_id(recipe_id: str):
+def get_recipe_by_id(recipe_id: str):
     """
     Fetches a recipe by its ID from Firestore.
     """
@@ -157,5 +120,8 @@ async def get_recipe_by_id(recipe_id: str):
     raise HTTPException(status_code=404, detail="Recipe not found")
 
 if __name__ == "__main__":
+    # Production runs gunicorn with several uvicorn workers (see Procfile).
+    # Each worker imports this module after the fork, so the Firebase, Gemini
+    # and yt-dlp clients are created per process and never shared across forks.
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=int(os.getenv("WEB_CONCURRENCY", "1")))
@@ -0,0 +1,96 @@
+"""
+One-time migration of recipes stored under their legacy MD5 IDs to the blake3 IDs.
+
+Every legacy document is merged into the document under its new ID and replaced by a
+{'movedTo': new_id} marker, which /recipes/{id} and /rate follow for IDs clients still hold.
+Users' saved_recipes arrays are rewritten to the new IDs.
+
+Run: python migrate_recipe_ids.py [--dry-run]
+"""
+import re
+import sys
+from firebase_admin import firestore
+from services.firebase_service import _DB, generate_recipe_id
+
+# Legacy IDs are full MD5 hex digests, blake3 IDs are 16 hex characters
+_LEGACY_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+def migrate_recipe(legacy_doc, dry_run: bool) -> str | None:
+    """
+    Moves one legacy recipe document to its new ID.
+    Returns the new ID, or None if the document was skipped.
+    """
+    data = legacy_doc.to_dict() or {}
+    if data.get('movedTo'):
+        # Already migrated by an earlier run
+        return data['movedTo']
+
+    source_url = data.get('source_url')
+    if not source_url:
+        print(f"Skipping {legacy_doc.id}: no source_url")
+        return None
+
+    new_id = generate_recipe_id(source_url)
+    new_ref = _DB.collection('recipes').document(new_id)
+    legacy_ref = legacy_doc.reference
+
+    @firestore.transactional
+    def move_in_transaction(transaction):
+        new_doc = new_ref.get(transaction=transaction)
+        if new_doc.exists:
+            # Earlier code copied legacy docs on read, so both may have been updated since.
+            # Keep the languages either one has and the rating with the most reviews.
+            merged = new_doc.to_dict()
+            translations = {**data.get('translations', {}), **merged.get('translations', {})}
+            merged['translations'] = translations
+            if int(data.get('reviews_count', 0)) > int(merged.get('reviews_count', 0)):
+                merged['rating'] = data.get('rating', 0.0)
+                merged['reviews_count'] = data.get('reviews_count', 0)
+        else:
+            merged = data
+
+        transaction.set(new_ref, merged)
+        # Replace the legacy copy so there is only one recipe left to update
+        transaction.set(legacy_ref, {'movedTo': new_id, 'source_url': source_url})
+
+    if dry_run:
+        print(f"Would move {legacy_doc.id} -> {new_id}")
+    else:
+        move_in_transaction(_DB.transaction())
+        print(f"Moved {legacy_doc.id} -> {new_id}")
+    return new_id
+
+def migrate_saved_recipes(moved: dict, dry_run: bool):
+    """
+    Rewrites legacy IDs in every user's saved_recipes array.
+    """
+    for user_doc in _DB.collection('users').stream():
+        saved = (user_doc.to_dict() or {}).get('saved_recipes') or []
+        # dict.fromkeys keeps the order and drops a recipe saved under both IDs
+        updated = list(dict.fromkeys(moved.get(recipe_id, recipe_id) for recipe_id in saved))
+        if updated == saved:
+            continue
+
+        if dry_run:
+            print(f"Would update saved_recipes of user {user_doc.id}")
+        else:
+            user_doc.reference.update({'saved_recipes': updated})
+            print(f"Updated saved_recipes of user {user_doc.id}")
+
+if __name__ == "__main__":
+    if _DB is None:
+        print("Firebase not initialized, nothing to migrate.")
+        sys.exit(1)
+
+    dry_run = "--dry-run" in sys.argv[1:]
+
+    moved = {}
+    for doc in _DB.collection('recipes').stream():
+        if not _LEGACY_ID_RE.match(doc.id):
+            continue
+        new_id = migrate_recipe(doc, dry_run)
+        if new_id:
+            moved[doc.id] = new_id
+
+    migrate_saved_recipes(moved, dry_run)
+    print(f"\n{len(moved)} legacy recipes migrated")
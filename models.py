@@ -1,4 +1,4 @@
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, ConfigDict, field_validator
 from typing import List, Optional
 
 class Ingredient(BaseModel):
@@ -12,6 +12,8 @@ class Step(BaseModel):
     ingredients: List[Ingredient] = []
 
 class Recipe(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     id: Optional[str] = None
     source_url: Optional[str] = None
     title: str
@@ -1,73 +1,185 @@
 import yt_dlp
 import os
+import re
 import uuid
+import urllib.request
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-def download_instagram_video(url: str, output_dir: str = "temp") -> tuple[str, dict]:
+# Shared yt-dlp instance
+# Building a YoutubeDL loads every extractor, so we do it once and reuse it.
+# YoutubeDL is not thread-safe: hold _YDL_LOCK while using it.
+_BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+_COOKIE_PATH = os.path.join(_BASE_DIR, "ig_cookies.txt")
+
+_YDL_OPTS = {
+    'format': 'best',
+    'noplaylist': True,
+    'cachedir': os.path.join(_BASE_DIR, ".yt-dlp-cache"),
+    # Fail fast on a stalled CDN instead of pinning a worker, retry transient errors
+    'socket_timeout': 30,
+    'retries': 3,
+    'fragment_retries': 3,
+    'http_headers': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    }
+}
+if os.path.exists(_COOKIE_PATH):
+    print(f"Using Instagram cookies from: {_COOKIE_PATH}")
+    _YDL_OPTS['cookiefile'] = _COOKIE_PATH
+
+_YDL = yt_dlp.YoutubeDL(_YDL_OPTS)
+_YDL_LOCK = threading.Lock()
+
+# Download directories already created in this process
+_OUTPUT_DIRS = set()
+
+# Author extraction patterns
+_TITLE_AUTHOR_RE = re.compile(r'Video by (\S+)')
+_IG_HANDLE_RE = re.compile(r'instagram\.com/([^/?#]+)')
+
+# Reserved first path segments that are not user handles
+_IG_RESERVED_PATHS = {'reel', 'p', 'stories', 'explore'}
+
+def _valid_handle(name: str | None) -> str | None:
+    # Numeric values are internal Instagram IDs, not handles
+    if name and not name.isdigit():
+        return name
+    return None
+
+# Author extraction strategies, in priority order.
+# For Instagram, uploader_id is often the handle, but sometimes numeric ID.
+# uploader is often the full name.
+# channel is sometimes the handle.
+def _from_uploader_id(info: dict, url: str) -> str | None:
+    return _valid_handle(info.get("uploader_id"))
+
+def _from_channel(info: dict, url: str) -> str | None:
+    return _valid_handle(info.get("channel"))
+
+def _from_title(info: dict, url: str) -> str | None:
+    # Match "Video by username" or similar patterns if they exist
+    # Based on user report: "Video by appetitnotv"
+    match = _TITLE_AUTHOR_RE.search(info.get("title") or "")
+    return _valid_handle(match.group(1)) if match else None
+
+def _from_url(info: dict, url: str) -> str | None:
+    # LAST RESORT: Extract from URL (e.g. instagram.com/username/reel/...)
+    # Note: The input URL might be shortened or different, but info['webpage_url'] should be canonical
+    match = _IG_HANDLE_RE.search(info.get("webpage_url", url))
+    if match and match.group(1) not in _IG_RESERVED_PATHS:
+        return _valid_handle(match.group(1))
+    return None
+
+_AUTHOR_STRATEGIES = [_from_uploader_id, _from_channel, _from_title, _from_url]
+
+def _extract_author_name(info: dict, url: str) -> str | None:
     """
-    Downloads an Instagram video using yt-dlp and returns the path to the file and metadata.
+    Returns the first handle found by the author strategies, or None.
     """
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    return next((name for strategy in _AUTHOR_STRATEGIES if (name := strategy(info, url))), None)
+
+# Parallel range download settings
+RANGE_CHUNK_SIZE = 512 * 1024 # bytes per range request
+RANGE_MAX_CONCURRENCY = 4
+RANGE_TIMEOUT = 30 # seconds per request
+
+def _download_ranged(info: dict) -> bytes | None:
+    """
+    Downloads the format selected by yt-dlp into memory with parallel HTTP range requests.
+    Returns None if the server doesn't support ranges (or the download fails),
+    so the caller can fall back to a regular yt-dlp download.
+    """
+    media_url = info.get("url")
+    if not media_url or info.get("protocol") not in ("http", "https"):
+        return None
+    headers = dict(info.get("http_headers") or {})
+
+    try:
+        head_request = urllib.request.Request(media_url, headers=headers, method="HEAD")
+        with urllib.request.urlopen(head_request, timeout=RANGE_TIMEOUT) as response:
+            size = int(response.headers.get("Content-Length") or 0)
+            accepts_ranges = response.headers.get("Accept-Ranges") == "bytes"
+    except Exception as e:
+        print(f"HEAD request failed: {e}")
+        return None
+
+    if not size or not accepts_ranges:
+        return None
+
+    # Preallocate the whole buffer, each range is copied straight into its slot
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+
+    def fetch_range(start: int, end: int):
+        request = urllib.request.Request(media_url, headers={**headers, "Range": f"bytes={start}-{end}"})
+        with urllib.request.urlopen(request, timeout=RANGE_TIMEOUT) as response:
+            if response.status != 206:
+                raise ValueError(f"Expected 206 for range {start}-{end}, got {response.status}")
+            data = response.read()
+        if len(data) != end - start + 1:
+            raise ValueError(f"Short read for range {start}-{end}")
+        view[start:end + 1] = data
+
+    try:
+        with ThreadPoolExecutor(max_workers=RANGE_MAX_CONCURRENCY) as executor:
+            futures = [
+                executor.submit(fetch_range, start, min(start + RANGE_CHUNK_SIZE, size) - 1)
+                for start in range(0, size, RANGE_CHUNK_SIZE)
+            ]
+            for future in futures:
+                future.result()
+        print(f"Downloaded {size} bytes in {len(futures)} parallel chunks")
+        return bytes(buffer)
+    except Exception as e:
+        print(f"Parallel range download failed: {e}")
+        return None
+
+def _download_to_memory(info: dict, output_dir: str) -> bytes:
+    """
+    Regular yt-dlp download through a temp file, read back into memory.
+    """
+    if output_dir not in _OUTPUT_DIRS:
+        # exist_ok: another worker thread may create it first
+        os.makedirs(output_dir, exist_ok=True)
+        _OUTPUT_DIRS.add(output_dir)
 
     # Generate a unique filename to avoid collisions
     file_id = str(uuid.uuid4())
     output_template = os.path.join(output_dir, f"{file_id}.%(ext)s")
 
-    ydl_opts = {
-        'outtmpl': output_template,
-        'format': 'best',
-        'noplaylist': True,
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        }
-    }
+    with _YDL_LOCK:
+        _YDL.params['outtmpl']['default'] = output_template
+        filename = _YDL.prepare_filename(info)
+        try:
+            _YDL.process_ie_result(info, download=True)
+            with open(filename, "rb") as f:
+                return f.read()
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
 
+def download_instagram_video(url: str, output_dir: str = "temp") -> tuple[bytes, dict]:
+    """
+    Downloads an Instagram video using yt-dlp and returns the video bytes and metadata.
+    The video is kept in memory so it can be handed to Gemini without touching disk.
+    """
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            
-            # Extract relevant metadata
-            # For Instagram, uploader_id is often the handle, but sometimes numeric ID.
-            # uploader is often the full name.
-            # channel is sometimes the handle.
-            
-            author_name = info.get("uploader_id")
-            
-            # Check if author_name is valid (not purely numeric)
-            if not author_name or (author_name.isdigit()):
-                # Try channel
-                if info.get("channel") and not info.get("channel").isdigit():
-                    author_name = info.get("channel")
-                
-                # Try extracting from title (e.g. "Video by appetitnotv")
-                if not author_name:
-                    title = info.get("title", "")
-                    import re
-                    # Match "Video by username" or similar patterns if they exist
-                    # Based on user report: "Video by appetitnotv"
-                    match = re.search(r'Video by ([^\s]+)', title)
-                    if match:
-                        author_name = match.group(1)
-
-            # LAST RESORT: Extract from URL (e.g. instagram.com/username/reel/...)
-            # Note: The input URL might be shortened or different, but info['webpage_url'] should be canonical
-            if not author_name or author_name.isdigit():
-                import re
-                webpage_url = info.get("webpage_url", url)
-                match = re.search(r'instagram\.com/([^/?#]+)', webpage_url)
-                if match:
-                    potential_handle = match.group(1)
-                    if potential_handle not in ['reel', 'p', 'stories', 'explore']:
-                        author_name = potential_handle
-
-            metadata = {
-                "author_name": author_name or info.get("uploader") or "Unknown Chef",
-                "title": info.get("title"),
-                "description": info.get("description")
-            }
-            
-            return filename, metadata
+        with _YDL_LOCK:
+            # Resolve the direct media URL first, then fetch it ourselves in parallel chunks
+            info = _YDL.extract_info(url, download=False)
+        video_data = _download_ranged(info)
+        if video_data is None:
+            print("Range download unavailable, falling back to yt-dlp download")
+            video_data = _download_to_memory(info, output_dir)
+
+        metadata = {
+            "author_name": _extract_author_name(info, url) or info.get("uploader") or "Unknown Chef",
+            "title": info.get("title"),
+            "description": info.get("description")
+        }
+        
+        return video_data, metadata
     except yt_dlp.utils.DownloadError as e:
         raise ValueError(f"Failed to download video: {str(e)}")
     except Exception as e:
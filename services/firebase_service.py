@@ -1,10 +1,28 @@
 import firebase_admin
 from firebase_admin import credentials, firestore, storage, messaging
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core.exceptions import NotFound
+from datetime import datetime, timedelta, timezone
 import os
-import hashlib
+import re
+from blake3 import blake3
 import time
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Write-behind queue for recipe saves
+# A single thread keeps writes in submission order (base recipe before its translations).
+_WRITE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="firestore-write")
+
+# Matches /reel/CODE or /p/CODE
+_IG_SHORTCODE_RE = re.compile(r'instagram\.com/(?:reel|p)/([^/?#]+)')
 
 # Initialize Firebase Admin
+# Firestore client and Storage bucket handles are created once here and shared,
+# so each call doesn't re-resolve credentials or open new gRPC channels.
+_DB = None
+_BUCKET = None
 try:
     cred = None
     # 1. Try local file
@@ -25,51 +43,62 @@ try:
         firebase_admin.initialize_app(cred, {
             'storageBucket': f"{cred.project_id}.firebasestorage.app" 
         })
+        _DB = firestore.client()
+        _BUCKET = storage.bucket()
         print("Firebase Admin initialized successfully.")
     else:
         print(f"Warning: No Firebase credentials found (checked {cred_path} and FIREBASE_CREDENTIALS_JSON). Firebase features will be disabled.")
 except Exception as e:
     print(f"Error initializing Firebase Admin: {e}")
 
-def upload_image(file_path: str, destination_blob_name: str) -> str | None:
-    """Uploads a file to the bucket and returns the public URL."""
+def upload_image_bytes(data: bytes, destination_blob_name: str, content_type: str = "image/png") -> str | None:
+    """Uploads in-memory image bytes to the bucket and returns the public URL."""
     if not firebase_admin._apps:
         print("Firebase not initialized, skipping upload.")
         return None
         
     try:
-        bucket = storage.bucket()
+        bucket = _BUCKET
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(file_path)
+        blob.upload_from_string(data, content_type=content_type)
         
         # Make public
         blob.make_public()
-        print(f"File {file_path} uploaded to {destination_blob_name}.")
+        print(f"Uploaded {len(data)} bytes to {destination_blob_name}.")
         return blob.public_url
     except Exception as e:
         print(f"Failed to upload image: {e}")
         return None
 
-def save_recipe_to_firestore(recipe_data: dict, source_url: str, language: str) -> str | None:
+def get_stored_image(blob_name: str, download: bool = True) -> tuple[str, bytes | None] | None:
     """
-    Saves or updates a recipe in Firestore.
-    Returns the document ID.
+    Returns (public URL, bytes) of a previously uploaded image, or None if it doesn't exist.
+    With download=False only the existence is checked and the bytes are None.
     """
     if not firebase_admin._apps:
-        print("Firebase not initialized, skipping Firestore save.")
         return None
         
-import re
+    try:
+        bucket = _BUCKET
+        blob = bucket.blob(blob_name)
+        if not download:
+            # Metadata request only, the image itself is served to clients from the URL
+            if not blob.exists():
+                return None
+            return blob.public_url, None
+        # One request: a missing blob raises NotFound
+        data = blob.download_as_bytes()
+        return blob.public_url, data
+    except NotFound:
+        return None
+    except Exception as e:
+        print(f"Failed to read stored image {blob_name}: {e}")
+        return None
 
-def generate_recipe_id(source_url: str) -> str:
-    """
-    Generates a unique ID for the recipe based on the source URL.
-    For Instagram, it tries to extract the shortcode (e.g. from /reel/SHORTCODE).
-    Falls back to hashing the URL without query parameters.
-    """
+def _recipe_key(source_url: str) -> str:
     # Try to extract Instagram shortcode
     # Matches /reel/CODE or /p/CODE
-    match = re.search(r'instagram\.com/(?:reel|p)/([^/?#]+)', source_url)
+    match = _IG_SHORTCODE_RE.search(source_url)
     if match:
         unique_key = match.group(1)
         # print(f"Extracted Instagram key: {unique_key}")
@@ -77,11 +106,34 @@ def generate_recipe_id(source_url: str) -> str:
         # Fallback: remove query params
         unique_key = source_url.split('?')[0].split('#')[0]
     
-    return hashlib.md5(unique_key.encode()).hexdigest()
+    return unique_key
 
-def save_recipe_to_firestore(recipe_data: dict, source_url: str, language: str) -> str | None:
+# Called several times per request for the same URL (cache checks, analysis, saves)
+@lru_cache(maxsize=4096)
+def generate_recipe_id(source_url: str) -> str:
+    """
+    Generates a unique ID for the recipe based on the source URL.
+    For Instagram, it tries to extract the shortcode (e.g. from /reel/SHORTCODE).
+    Falls back to hashing the URL without query parameters.
+    """
+    unique_key = _recipe_key(source_url)
+    return blake3(unique_key.encode()).hexdigest(length=8)
+
+def resolve_moved_recipe(doc, transaction=None):
+    """
+    Follows the movedTo marker left in a recipe document by migrate_recipe_ids.py.
+    Returns the snapshot of the document the recipe now lives in (or doc itself).
+    """
+    moved_to = (doc.to_dict() or {}).get('movedTo') if doc.exists else None
+    if not moved_to:
+        return doc
+    return _DB.collection('recipes').document(moved_to).get(transaction=transaction)
+
+def save_recipe_to_firestore(recipe_data: dict, source_url: str, language: str, prompt_version: str | None = None, only_if_missing: bool = False) -> str | None:
     """
     Saves or updates a recipe in Firestore.
+    prompt_version records which analysis prompt produced a newly created recipe.
+    With only_if_missing an existing translation for the language is left as is.
     Returns the document ID.
     """
     if not firebase_admin._apps:
@@ -89,24 +141,35 @@ def save_recipe_to_firestore(recipe_data: dict, source_url: str, language: str)
         return None
         
     try:
-        db = firestore.client()
+        db = _DB
         
         # Generate ID
         recipe_id = generate_recipe_id(source_url)
         
         doc_ref = db.collection('recipes').document(recipe_id)
-        doc = doc_ref.get()
         
-        if doc.exists:
-            # Update existing document: merge translation
-            print(f"Updating existing recipe {recipe_id} for language {language}")
-            doc_ref.set({
-                'translations': {
-                    language: recipe_data
-                }
-            }, merge=True)
-            return recipe_id
-        else:
+        @firestore.transactional
+        def save_in_transaction(transaction, doc_ref):
+            # Only this language is read, whether the document exists comes with it.
+            # The transaction is retried if another save changes the document before the commit.
+            doc = doc_ref.get(field_paths=[FieldPath('translations', language).to_api_repr()], transaction=transaction)
+            
+            if doc.exists and only_if_missing and language in (doc.to_dict() or {}).get('translations', {}):
+                # Another request (or process) already saved this translation since our cache check,
+                # rewriting the same recipe would only cost a billable write
+                print(f"Recipe {recipe_id} already has language {language}, skipping save")
+                return
+            
+            if doc.exists:
+                # Update existing document: merge translation
+                print(f"Updating existing recipe {recipe_id} for language {language}")
+                transaction.set(doc_ref, {
+                    'translations': {
+                        language: recipe_data
+                    }
+                }, merge=True)
+                return
+            
             # Create new document
             print(f"Creating new recipe {recipe_id}")
             
@@ -128,17 +191,38 @@ def save_recipe_to_firestore(recipe_data: dict, source_url: str, language: str)
                 }
             }
             
+            # Lets recipes from an older prompt be found (and regenerated) after a prompt change
+            if prompt_version:
+                new_recipe['promptVersion'] = prompt_version
+            
             # Add hero image if available in the recipe data (it might be in steps)
             if recipe_data.get('hero_image_url'):
                  new_recipe['hero_image_url'] = recipe_data.get('hero_image_url')
             
-            doc_ref.set(new_recipe)
-            return recipe_id
+            transaction.set(doc_ref, new_recipe)
+        
+        transaction = db.transaction()
+        save_in_transaction(transaction, doc_ref)
+        return recipe_id
             
     except Exception as e:
         print(f"Failed to save recipe to Firestore: {e}")
         return None
 
+def queue_save_recipe(recipe_data: dict, source_url: str, language: str, prompt_version: str | None = None, only_if_missing: bool = False) -> Future:
+    """
+    Schedules save_recipe_to_firestore on the write-behind queue and returns immediately.
+    The returned future resolves to the document ID.
+    """
+    return _WRITE_EXECUTOR.submit(save_recipe_to_firestore, recipe_data, source_url, language, prompt_version, only_if_missing)
+
+def flush_recipe_writes(timeout: float | None = None):
+    """
+    Blocks until every recipe save queued so far has been written.
+    """
+    # The queue is FIFO, so once this no-op runs all earlier writes are done
+    _WRITE_EXECUTOR.submit(lambda: None).result(timeout=timeout)
+
 def get_recipe_from_firestore(source_url: str) -> dict | None:
     """
     Fetches a recipe from Firestore by source URL hash.
@@ -148,7 +232,7 @@ def get_recipe_from_firestore(source_url: str) -> dict | None:
         return None
         
     try:
-        db = firestore.client()
+        db = _DB
         recipe_id = generate_recipe_id(source_url)
         print(f"Checking Firestore cache for recipe ID: {recipe_id} (from URL: {source_url})")
         doc_ref = db.collection('recipes').document(recipe_id)
@@ -163,6 +247,33 @@ def get_recipe_from_firestore(source_url: str) -> dict | None:
         print(f"Failed to fetch recipe from Firestore: {e}")
         return None
 
+def get_recipe_translations(source_url: str, languages: list[str]) -> dict | None:
+    """
+    Fetches only some languages of a recipe, plus the fields shared across languages.
+    Returns the projected document data if it exists, else None.
+    """
+    if not firebase_admin._apps:
+        return None
+
+    try:
+        recipe_id = generate_recipe_id(source_url)
+        doc_ref = _DB.collection('recipes').document(recipe_id)
+        # Field mask: the other translations never leave Firestore, and a missing
+        # language is just absent from the (small) result.
+        # FieldPath quotes language codes like zh-CN that aren't plain identifiers.
+        doc = doc_ref.get(field_paths=[
+            *(FieldPath('translations', language).to_api_repr() for language in dict.fromkeys(languages)),
+            'rating',
+            'reviews_count',
+            'hero_image_url',
+        ])
+        if doc.exists:
+            return doc.to_dict()
+        return None
+    except Exception as e:
+        print(f"Failed to fetch recipe translations from Firestore: {e}")
+        return None
+
 def update_recipe_rating(recipe_id: str, new_rating: int) -> dict | None:
     """
     Updates the recipe rating atomically.
@@ -171,14 +282,16 @@ def update_recipe_rating(recipe_id: str, new_rating: int) -> dict | None:
         return None
         
     try:
-        db = firestore.client()
+        db = _DB
         doc_ref = db.collection('recipes').document(recipe_id)
         
         @firestore.transactional
         def update_in_transaction(transaction, doc_ref):
-            snapshot = doc_ref.get(transaction=transaction)
+            # Legacy IDs saved by clients point at a movedTo marker, rate the recipe it points to
+            snapshot = resolve_moved_recipe(doc_ref.get(transaction=transaction), transaction)
             if not snapshot.exists:
                 return None
+            doc_ref = snapshot.reference
             
             data = snapshot.to_dict()
             current_rating = float(data.get('rating', 0.0))
@@ -196,7 +309,8 @@ def update_recipe_rating(recipe_id: str, new_rating: int) -> dict | None:
                 'reviews_count': new_count
             })
             
-            return {'rating': new_average, 'reviews_count': new_count}
+            # id is the recipe that was rated, which differs from recipe_id for a moved recipe
+            return {'id': doc_ref.id, 'rating': new_average, 'reviews_count': new_count}
             
         transaction = db.transaction()
         result = update_in_transaction(transaction, doc_ref)
@@ -251,7 +365,7 @@ def add_recipe_to_user(user_id: str, recipe_id: str) -> bool:
         return False
         
     try:
-        db = firestore.client()
+        db = _DB
         user_ref = db.collection('users').document(user_id)
         
         # Atomically add to array
@@ -274,8 +388,8 @@ def get_recipe_by_id_from_firestore(recipe_id: str) -> dict | None:
         return None
         
     try:
-        db = firestore.client()
-        doc = db.collection("recipes").document(recipe_id).get()
+        db = _DB
+        doc = resolve_moved_recipe(db.collection("recipes").document(recipe_id).get())
         if doc.exists:
             data = doc.to_dict()
             data['id'] = doc.id
@@ -284,3 +398,140 @@ def get_recipe_by_id_from_firestore(recipe_id: str) -> dict | None:
     except Exception as e:
         print(f"Error fetching recipe {recipe_id}: {e}")
         return None
+
+def _llm_cache_doc_id(input_hash: str, prompt_version: str) -> str:
+    return f"{input_hash}_{prompt_version}"
+
+def get_llm_cache(input_hash: str, prompt_version: str) -> dict | None:
+    """
+    Fetches a cached LLM response from the llmCache collection.
+    Returns the stored response if present and not expired, else None.
+    """
+    if not firebase_admin._apps:
+        return None
+        
+    try:
+        db = _DB
+        doc = db.collection('llmCache').document(_llm_cache_doc_id(input_hash, prompt_version)).get()
+        if not doc.exists:
+            return None
+        
+        entry = doc.to_dict()
+        expires_at = entry.get('expiresAt')
+        if expires_at and expires_at < datetime.now(timezone.utc):
+            print(f"LLM cache entry for {input_hash} ({prompt_version}) expired")
+            return None
+        return entry.get('response')
+    except Exception as e:
+        print(f"Failed to read LLM cache: {e}")
+        return None
+
+def save_llm_cache(input_hash: str, prompt_version: str, response: dict, ttl_seconds: int) -> bool:
+    """
+    Stores an LLM response in the llmCache collection.
+    expiresAt can double as the field for a Firestore TTL policy.
+    """
+    if not firebase_admin._apps:
+        return False
+        
+    try:
+        db = _DB
+        db.collection('llmCache').document(_llm_cache_doc_id(input_hash, prompt_version)).set({
+            'inputHash': input_hash,
+            'promptVersion': prompt_version,
+            'response': response,
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'expiresAt': datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+        })
+        print(f"Saved LLM cache entry for {input_hash} ({prompt_version})")
+        return True
+    except Exception as e:
+        print(f"Failed to save LLM cache: {e}")
+        return False
+
+def invalidate_llm_cache(prompt_version: str) -> int:
+    """
+    Deletes all llmCache entries for the given prompt version.
+    Returns the number of deleted entries.
+    """
+    if not firebase_admin._apps:
+        return 0
+        
+    try:
+        db = _DB
+        docs = db.collection('llmCache').where(filter=FieldFilter('promptVersion', '==', prompt_version)).stream()
+        batch = db.batch()
+        count = 0
+        for doc in docs:
+            batch.delete(doc.reference)
+            count += 1
+            # Firestore batches are limited to 500 operations
+            if count % 500 == 0:
+                batch.commit()
+                batch = db.batch()
+        batch.commit()
+        print(f"Invalidated {count} LLM cache entries for prompt {prompt_version}")
+        return count
+    except Exception as e:
+        print(f"Failed to invalidate LLM cache: {e}")
+        return 0
+
+def get_gemini_file(content_hash: str) -> str | None:
+    """
+    Returns the name of a Gemini file previously uploaded for this video content hash,
+    if it hasn't expired yet.
+    """
+    if not firebase_admin._apps:
+        return None
+        
+    try:
+        db = _DB
+        doc = db.collection('geminiFiles').document(content_hash).get()
+        if not doc.exists:
+            return None
+        
+        entry = doc.to_dict()
+        if entry.get('expiresAt') and entry['expiresAt'] < datetime.now(timezone.utc):
+            return None
+        return entry.get('fileName')
+    except Exception as e:
+        print(f"Failed to read Gemini file cache: {e}")
+        return None
+
+def save_gemini_file(content_hash: str, file_name: str, ttl_seconds: int) -> bool:
+    """
+    Remembers the Gemini file uploaded for this video content hash.
+    """
+    if not firebase_admin._apps:
+        return False
+        
+    try:
+        db = _DB
+        db.collection('geminiFiles').document(content_hash).set({
+            'fileName': file_name,
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'expiresAt': datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+        })
+        return True
+    except Exception as e:
+        print(f"Failed to save Gemini file cache: {e}")
+        return False
+
+def warm_up_firebase():
+    """
+    Opens the Firestore gRPC channel and Storage session ahead of the first request.
+    """
+    if not firebase_admin._apps:
+        return
+
+    try:
+        _DB.collection('recipes').limit(1).get()
+        print("Firestore connection warmed up")
+    except Exception as e:
+        print(f"Failed to warm up Firestore: {e}")
+
+    try:
+        _BUCKET.exists()
+        print("Storage bucket warmed up")
+    except Exception as e:
+        print(f"Failed to warm up Storage bucket: {e}")
@@ -1,43 +1,455 @@
 from google import genai
-from google.genai import types
+from google.genai import types, errors
 import os
+import io
+import logging
 import time
-import json
-import hashlib
+import random
+import threading
+import orjson
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, Future
+from blake3 import blake3
 from models import Recipe, Step, Ingredient
 from dotenv import load_dotenv
-from services.firebase_service import upload_image, save_recipe_to_firestore, get_recipe_from_firestore, generate_recipe_id
+import httpx
+from services.firebase_service import upload_image_bytes, get_stored_image, queue_save_recipe, get_recipe_from_firestore, get_recipe_translations, generate_recipe_id, get_llm_cache, save_llm_cache, get_gemini_file, save_gemini_file
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 api_key = os.getenv("GEMINI_API_KEY")
 if not api_key:
     raise ValueError("GEMINI_API_KEY environment variable not set")
 
-client = genai.Client(api_key=api_key)
+# Single shared client: its httpx pool keeps TLS connections to Gemini alive between calls.
+# httpx drops idle connections after 5s by default, which is shorter than the gaps
+# between calls in one analysis (polling, per-step images), so keep them longer.
+# Requests time out after GEMINI_HTTP_TIMEOUT so a stalled call can't hold a worker indefinitely.
+GEMINI_HTTP_TIMEOUT = 120_000 # ms
+
+client = genai.Client(
+    api_key=api_key,
+    http_options=types.HttpOptions(
+        timeout=GEMINI_HTTP_TIMEOUT,
+        client_args={
+            "limits": httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+        }
+    )
+)
+
+# Bump whenever the analysis prompt changes so cached LLM responses are invalidated
+PROMPT_VERSION = "v1"
+LLM_CACHE_TTL = 7 * 86400 # seconds
+
+# Gemini file processing poll (seconds)
+FILE_POLL_INITIAL_DELAY = 0.5
+FILE_POLL_BACKOFF = 1.5
+FILE_POLL_MAX_DELAY = 5
+FILE_POLL_JITTER = 0.1
+FILE_POLL_MAX_FAILURES = 3 # consecutive failed status checks before giving up
+FILE_PROCESSING_MAX_WAIT = 180
+
+# Gemini keeps uploaded files for 48h, stop reusing them a bit earlier
+GEMINI_FILE_TTL = 47 * 3600 # seconds
+
+IMAGE_MODEL = "gemini-3-pro-image-preview"
+
+# Output schemas: Gemini then only returns JSON of this shape, no fences or prose.
+# The recipe ones keep the prompt's field order, the step stream parser needs the header before "steps".
+_S = types.Schema
+_INGREDIENTS_SCHEMA = _S(type="ARRAY", items=_S(
+    type="OBJECT",
+    properties={"name": _S(type="STRING"), "amount": _S(type="STRING"), "unit": _S(type="STRING")},
+    required=["name", "amount", "unit"],
+    property_ordering=["name", "amount", "unit"],
+))
+_RECIPE_FIELDS = ["title", "description", "category", "time", "difficulty", "calories"]
+_RECIPE_SCHEMA = _S(
+    type="OBJECT",
+    properties={
+        **{field: _S(type="STRING") for field in _RECIPE_FIELDS},
+        "ingredients": _INGREDIENTS_SCHEMA,
+        "steps": _S(type="ARRAY", items=_S(
+            type="OBJECT",
+            properties={"description": _S(type="STRING"), "ingredients": _INGREDIENTS_SCHEMA},
+            required=["description", "ingredients"],
+            property_ordering=["description", "ingredients"],
+        )),
+    },
+    required=_RECIPE_FIELDS + ["ingredients", "steps"],
+    property_ordering=_RECIPE_FIELDS + ["ingredients", "steps"],
+)
+
+_EXTRACT_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=_RECIPE_SCHEMA
+)
+_TRANSLATE_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=list[str]
+)
+_TRANSLATE_BATCH_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=list[list[str]]
+)
+# One object per language instead of an object keyed by language code, schemas can't have dynamic keys
+_TRANSLATE_MULTI_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=_S(type="ARRAY", items=_S(
+        type="OBJECT",
+        properties={"language": _S(type="STRING"), "strings": _S(type="ARRAY", items=_S(type="STRING"))},
+        required=["language", "strings"],
+        property_ordering=["language", "strings"],
+    ))
+)
+
+# Same output settings for every step and hero image, built once
+_IMAGE_CONFIG = types.GenerateContentConfig(
+    response_modalities=['IMAGE'],
+    image_config=types.ImageConfig(
+        aspect_ratio="9:16",
+        image_size="1024x1024"
+    )
+)
+
+# Max concurrent step image generations per recipe
+# Defaults low enough for the image model's per-minute quota across several workers, tune per deployment.
+STEP_IMAGE_CONCURRENCY = int(os.getenv("STEP_IMAGE_CONCURRENCY", "5"))
+# Process-wide cap on image model requests, shared by every recipe a worker processes at once (0 disables)
+IMAGE_REQUESTS_PER_SECOND = float(os.getenv("IMAGE_REQUESTS_PER_SECOND", "5"))
+
+# The dedicated hero image is one more image model call per recipe, conditioned on all step images.
+# Off by default: the last step image (usually the plated dish) is used as the hero instead.
+GENERATE_HERO_IMAGE = os.getenv("GENERATE_HERO_IMAGE") == "1"
+# Step images sent as context for the hero, the last ones show the finished dish
+HERO_CONTEXT_IMAGES = 2
+
+# Experimental: get the recipe and its step images from one image model call.
+# Off by default, falls back to extraction + per-step image calls when no images come back.
+FUSED_STEP_IMAGES = os.getenv("FUSED_STEP_IMAGES") == "1"
+
+# Prompts are built once, only the small variable parts are filled in per call.
+# Bump PROMPT_VERSION when changing _ANALYZE_PROMPT.
+_ANALYZE_PROMPT = """
+    Analyze this video and extract the recipe.
+    Return the result in JSON format with the following structure:
+    {
+        "title": "Recipe Title",
+        "description": "Short description (max 2 sentences)",
+        "category": "Category (e.g., Breakfast, Lunch, Dinner, Dessert, Snack)",
+        "time": "Total cooking time (e.g., 25 min)",
+        "difficulty": "Difficulty level (Easy, Medium, Hard)",
+        "calories": "Estimated calories per serving (e.g., 450)",
+        "ingredients": [
+            {"name": "Ingredient Name", "amount": "Amount", "unit": "Unit"}
+        ],
+        "steps": [
+            {
+                "description": "Step 1 description",
+                "ingredients": [
+                    {"name": "Ingredient Name", "amount": "Amount", "unit": "Unit"}
+                ]
+            },
+            {
+                "description": "Step 2 description",
+                 "ingredients": []
+            }
+        ]
+    }
+    Ensure the output is valid JSON. Do not include markdown code blocks.
+    Response MUST be in English.
+    """
+
+_TRANSLATE_PROMPT = """
+    Translate each string in this JSON array to language code '{language}'.
+    These are the title, description, category, difficulty, cooking time, calories, ingredient names, amounts, units and step descriptions of a recipe.
+    Return ONLY a JSON array of strings with exactly {count} items, in the same order.
+    
+    {strings}
+    """
+
+_TRANSLATE_MULTI_PROMPT = """
+    Translate each string in this JSON array to each of these language codes: {languages}.
+    These are the title, description, category, difficulty, cooking time, calories, ingredient names, amounts, units and step descriptions of a recipe.
+    Return ONLY a JSON array with one object per language code, holding the language code and its translated strings.
+    Each strings array must have exactly {count} items, in the same order.
+    
+    {strings}
+    """
+
+_TRANSLATE_BATCH_PROMPT = """
+    Translate the strings of each job in this JSON array to the job's language code.
+    Each job holds the title, description, category, difficulty, cooking time, calories, ingredient names, amounts, units and step descriptions of a recipe.
+    Return ONLY a JSON array with one JSON array of strings per job, in the same order as the jobs.
+    Each of them must have exactly as many items as its job's strings, in the same order.
+    
+    {jobs}
+    """
+
+# Step image prompts are also the shared image cache key, keep their wording stable
+_STEP_IMAGE_PROMPT = "Food photography, vertical 9:16 aspect ratio. Create a high quality, appetizing image for this recipe step: {step}. The dish is {title}. No text, no words, no letters."
+_HERO_IMAGE_PROMPT = "Food photography, vertical 9:16 aspect ratio. A cinematic, high-end hero shot of the final dish: {title}. {description}. The image should look like a professional magazine cover or cookbook photo. Make it appetizing and beautiful. No text."
+
+_FUSED_IMAGES_PROMPT = """
+    After the JSON, generate one image for each step, in the same order as the steps.
+    Food photography, vertical 9:16 aspect ratio, high quality and appetizing, consistent with the dish.
+    No text, no words, no letters in the images.
+    """
+
+# Retries for transient Gemini errors: rate limited, internal, unavailable, deadline exceeded
+RETRYABLE_CODES = {429, 500, 503, 504}
+RETRY_BASE_DELAY = 1.0 # seconds
+RETRY_MAX_DELAY = 30
+
+# Translations memoized in-process, keyed by the recipe strings and target language
+TRANSLATION_CACHE_SIZE = 512
+# Concurrent translations (other recipes, other languages) share one Gemini call.
+# A job waits up to the window for company, 0 disables batching.
+TRANSLATION_BATCH_WINDOW = float(os.getenv("TRANSLATION_BATCH_WINDOW", "0.2")) # seconds
+TRANSLATION_BATCH_MAX_JOBS = 16
+
+# Recipes recently served by get_cached_recipe, kept per process to skip the Firestore read.
+# Entries are dropped when this process changes the recipe, the TTL bounds staleness across processes.
+RECIPE_CACHE_TTL = 300 # seconds
+RECIPE_CACHE_SIZE = 2048 # recipes, all their languages count as one
+
+# Instagram serves reels as MP4
+VIDEO_MIME_TYPE = "video/mp4"
 
 # Local cache for translated/generated files is less important now, but we can keep it as backup if needed.
 # For now, we will rely on Firestore check effectively serving as cache check if the document exists.
 
-def get_cached_recipe(video_url: str, language: str) -> Recipe | None:
+def warm_up_gemini():
+    """
+    Opens a pooled connection to the Gemini API ahead of the first request.
+    """
+    try:
+        next(iter(client.files.list(config=types.ListFilesConfig(page_size=1))), None)
+        logger.info("Gemini connection warmed up")
+    except Exception as e:
+        logger.warning("Failed to warm up Gemini: %s", e)
+
+def _parse_retry_after(err) -> float | None:
+    """
+    Wait suggested by the server: the Retry-After header, or the retryDelay Gemini puts in 429 error details.
+    """
+    headers = getattr(getattr(err, "response", None), "headers", None)
+    if headers and headers.get("retry-after"):
+        try:
+            return float(headers.get("retry-after"))
+        except ValueError:
+            pass # HTTP-date form, fall back to our own backoff
+
+    details = getattr(err, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", {}).get("details", []):
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None # e.g. "12s"
+            if isinstance(delay, str) and delay.endswith("s"):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    pass
+    return None
+
+class _NoImageError(Exception):
+    """The image model answered without an image (e.g. text only), worth asking again."""
+
+def _is_retryable(err) -> bool:
+    if isinstance(err, errors.APIError):
+        return err.code in RETRYABLE_CODES
+    return isinstance(err, (httpx.TransportError, _NoImageError))
+
+def _call_with_retries(fn, *args, max_retries: int = 3, **kwargs):
+    """
+    Calls fn, retrying transient Gemini failures (rate limits, overload, timeouts) with backoff.
+    Anything else, or the last failure, is raised.
+    """
+    for attempt in range(max_retries):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == max_retries - 1 or not _is_retryable(e):
+                raise
+            delay = _retry_delay(e, attempt)
+            logger.warning("Gemini call failed (%s), retrying in %.1fs", e, delay)
+            time.sleep(delay)
+
+class _RateLimiter:
+    """
+    Spaces calls at least 1/rate seconds apart across all threads of the process.
+    """
+    def __init__(self, rate: float):
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self._interval:
+            return
+        # Reserve the next free slot under the lock, sleep outside it
+        with self._lock:
+            slot = max(time.monotonic(), self._next_slot)
+            self._next_slot = slot + self._interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+_image_rate_limiter = _RateLimiter(IMAGE_REQUESTS_PER_SECOND)
+
+def _generate_image(contents) -> bytes:
+    # Retries go through here too, so they wait for a slot as well
+    _image_rate_limiter.wait()
+    response = client.models.generate_content(
+        model=IMAGE_MODEL,
+        contents=contents,
+        config=_IMAGE_CONFIG
+    )
+    for part in response.parts or []:
+        if part.inline_data:
+            return part.inline_data.data
+    raise _NoImageError("Image model returned no image")
+
+def _retry_delay(err, attempt: int) -> float:
+    retry_after = _parse_retry_after(err)
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY)
+    # Jittered exponential backoff so concurrent workers don't retry in lockstep
+    return random.uniform(0.5, 1.5) * min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+
+def _parse_json_response(text: str):
+    """
+    Parses a model response as JSON.
+    Only for responses without a schema: with one, Gemini returns bare JSON (see response.parsed).
+    Bare JSON takes the fast path, otherwise the outermost {...} / [...] block is sliced out of
+    markdown fences, surrounding prose or tags before giving up.
+    """
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    # Slice from the first opening bracket to the last matching closing one
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if starts:
+        start = min(starts)
+        end = text.rfind('}' if text[start] == '{' else ']')
+        if end > start:
+            return orjson.loads(text[start:end + 1])
+    raise ValueError(f"No JSON found in response: {text[:200]}")
+
+_RECIPE_CACHE = {} # recipe_id -> {language: (expires_at, recipe)}, oldest recipe first
+_RECIPE_CACHE_LOCK = threading.Lock()
+
+def _get_memoized_recipe(recipe_id: str, language: str) -> Recipe | None:
+    with _RECIPE_CACHE_LOCK:
+        entry = _RECIPE_CACHE.get(recipe_id, {}).get(language)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+def _memoize_recipe(recipe_id: str, language: str, recipe: Recipe):
+    with _RECIPE_CACHE_LOCK:
+        if recipe_id not in _RECIPE_CACHE and len(_RECIPE_CACHE) >= RECIPE_CACHE_SIZE:
+            # Dicts keep insertion order, evict the oldest recipe
+            del _RECIPE_CACHE[next(iter(_RECIPE_CACHE))]
+        _RECIPE_CACHE.setdefault(recipe_id, {})[language] = (time.monotonic() + RECIPE_CACHE_TTL, recipe)
+
+def forget_cached_recipe(recipe_id: str):
+    """
+    Drops every language of a recipe from this process's cache, call it after the recipe changes.
+    """
+    with _RECIPE_CACHE_LOCK:
+        _RECIPE_CACHE.pop(recipe_id, None)
+
+def get_cached_recipe(video_url: str, language: str, allow_translation: bool = True) -> Recipe | None:
+    """
+    Returns the cached recipe in the requested language.
+    If only the 'en' base exists it is translated (and saved) unless allow_translation is False.
+    Recipes are shared with later calls for RECIPE_CACHE_TTL, don't modify the result.
+    """
+    recipe_id = generate_recipe_id(video_url)
+    recipe = _get_memoized_recipe(recipe_id, language)
+    if recipe:
+        return recipe
+
+    # Only the requested language and the 'en' base can be used, don't download the others
+    languages = [language, 'en'] if allow_translation else [language]
+    projected = get_recipe_translations(video_url, languages)
+    recipe = get_cached_recipe_from_doc(projected, video_url, language, allow_translation)
+
+    # A failed translation falls back to the English recipe, ask again next time
+    if recipe and recipe.language == language:
+        _memoize_recipe(recipe_id, language, recipe)
+    return recipe
+
+_RECIPE_REQUIRED_FIELDS = {name for name, field in Recipe.model_fields.items() if field.is_required()}
+
+def _construct_recipe(data: dict) -> Recipe:
+    """
+    Builds a Recipe from stored data without running validation.
+    Stored translations are model_dump() output of an already validated Recipe,
+    anything incomplete (hand-edited or very old documents) still goes through validation.
+    """
+    if not _RECIPE_REQUIRED_FIELDS <= data.keys():
+        return Recipe(**data)
+    steps = []
+    for step in data['steps']:
+        ingredients = [Ingredient.model_construct(**ing) for ing in step.get('ingredients', [])]
+        steps.append(Step.model_construct(**{**step, 'ingredients': ingredients}))
+    ingredients = [Ingredient.model_construct(**ing) for ing in data['ingredients']]
+    return Recipe.model_construct(**{**data, 'ingredients': ingredients, 'steps': steps})
+
+def _recipe_from_doc(existing_data: dict, video_url: str, language: str) -> Recipe:
+    """
+    Builds the cached recipe for a language stored in the document's translations map.
+    """
+    cached_recipe = _construct_recipe(existing_data['translations'][language])
+    cached_recipe.id = generate_recipe_id(video_url)
+    # Use global rating if available
+    if 'rating' in existing_data:
+        cached_recipe.rating = float(existing_data['rating'])
+    if 'reviews_count' in existing_data:
+        cached_recipe.reviews_count = int(existing_data['reviews_count'])
+    cached_recipe.source_url = video_url
+    cached_recipe.language = language
+    if not cached_recipe.hero_image_url and existing_data.get('hero_image_url'):
+        cached_recipe.hero_image_url = existing_data.get('hero_image_url')
+    return cached_recipe
+
+def get_cached_recipes(video_url: str, languages: list[str]) -> dict[str, Recipe]:
+    """
+    Returns the recipe in each requested language from a single Firestore read.
+    Missing languages are translated from the 'en' base together in one call and saved.
+    """
     existing_data = get_recipe_from_firestore(video_url)
+    if not existing_data:
+        return {}
+
+    translations = existing_data.get('translations', {})
+    recipes = {lang: _recipe_from_doc(existing_data, video_url, lang) for lang in languages if lang in translations}
+    missing = [lang for lang in dict.fromkeys(languages) if lang not in recipes]
+    if missing and 'en' in translations:
+        base_recipe = _recipe_from_doc(existing_data, video_url, 'en')
+        for lang, translated in translate_recipe_multi(base_recipe, missing).items():
+            # Not saved when the translation failed and fell back to the English recipe
+            if translated.language == lang:
+                queue_save_recipe(translated.model_dump(), video_url, lang, only_if_missing=True)
+            translated.id = base_recipe.id
+            recipes[lang] = translated
+    return recipes
+
+def get_cached_recipe_from_doc(existing_data: dict | None, video_url: str, language: str, allow_translation: bool = True) -> Recipe | None:
+    """
+    Same as get_cached_recipe, but works on an already fetched Firestore document
+    so several languages can be checked with a single read.
+    """
     if existing_data:
         # 1. Check if exact language exists
         translations = existing_data.get('translations', {})
         if language in translations:
-            print(f"Main: Found cached recipe for {language}")
-            cached_recipe = Recipe(**translations[language])
-            cached_recipe.id = generate_recipe_id(video_url)
-            # Use global rating if available
-            if 'rating' in existing_data:
-                cached_recipe.rating = float(existing_data['rating'])
-            if 'reviews_count' in existing_data:
-                cached_recipe.reviews_count = int(existing_data['reviews_count'])
-            cached_recipe.source_url = video_url
-            cached_recipe.language = language
-            if not cached_recipe.hero_image_url and existing_data.get('hero_image_url'):
-                cached_recipe.hero_image_url = existing_data.get('hero_image_url')
-            return cached_recipe
+            logger.info("Main: Found cached recipe for %s", language)
+            return _recipe_from_doc(existing_data, video_url, language)
         
         # 2. Check if 'en' exists (base) - usually strictly speaking main.py logic check
         # But here we just return None if specific lang not found so main.py triggers analysis
@@ -84,192 +496,734 @@ def get_cached_recipe(video_url: str, language: str) -> Recipe | None:
         # Or make get_cached_recipe smart enough to translate?
         # Smart get_cached_recipe is better for encapsulation.
         
-        if 'en' in translations:
-             print(f"Main: Found base 'en' recipe, translating to {language}...")
-             base_recipe = Recipe(**translations['en'])
-             base_recipe.id = generate_recipe_id(video_url)
-             # Use global rating if available
-             if 'rating' in existing_data:
-                 base_recipe.rating = float(existing_data['rating'])
-             if 'reviews_count' in existing_data:
-                 base_recipe.reviews_count = int(existing_data['reviews_count'])
-             base_recipe.source_url = video_url
-             if not base_recipe.hero_image_url and existing_data.get('hero_image_url'):
-                 base_recipe.hero_image_url = existing_data.get('hero_image_url')
+        if allow_translation and 'en' in translations:
+             logger.info("Main: Found base 'en' recipe, translating to %s...", language)
+             base_recipe = _recipe_from_doc(existing_data, video_url, 'en')
 
              translated = translate_recipe(base_recipe, language)
              # We should probably save it too?
-             # Yes, save the translation.
-             save_recipe_to_firestore(translated.dict(), video_url, language)
+             # Yes, save the translation (unless it failed and fell back to English).
+             if translated.language == language:
+                 queue_save_recipe(translated.model_dump(), video_url, language, only_if_missing=True)
              translated.id = base_recipe.id
              return translated
 
     return None
 
-def translate_recipe(recipe: Recipe, target_language: str) -> Recipe:
-    print(f"Translating recipe to {target_language}...")
-    prompt = f"""
-    Translate this recipe JSON to language code '{target_language}'.
-    Preserve the JSON structure exactly.
-    Do NOT translate the keys.
-    Do NOT translate image_url.
-    Translate title, description, category, difficulty, time, calories, ingredient names, ingredient amounts, ingredient units, step descriptions, and step ingredients (if any).
-    
-    Recipe JSON:
-    {recipe.json()}
-    
-    Return ONLY valid JSON.
+def get_cached_analysis(video_url: str) -> dict | None:
+    """
+    Returns the cached raw Gemini extraction for this video (current prompt version), if any.
+    """
+    return get_llm_cache(generate_recipe_id(video_url), PROMPT_VERSION)
+
+def _translatable_strings(recipe: Recipe) -> list[str]:
+    """
+    Human-readable strings of a recipe, in a fixed order matching _with_translated_strings.
+    """
+    strings = [recipe.title, recipe.description, recipe.category, recipe.difficulty, recipe.time, recipe.calories]
+    for ing in recipe.ingredients:
+        strings += [ing.name, ing.amount, ing.unit]
+    for step in recipe.steps:
+        strings.append(step.description)
+        for ing in step.ingredients:
+            strings += [ing.name, ing.amount, ing.unit]
+    return strings
+
+def _with_translated_strings(recipe: Recipe, strings: list[str]) -> Recipe:
+    """
+    Copy of the recipe with its strings replaced, everything else (IDs, images, ratings) is kept.
+    """
+    it = iter(strings)
+    translated = recipe.model_copy(deep=True)
+    translated.title = next(it)
+    translated.description = next(it)
+    translated.category = next(it)
+    translated.difficulty = next(it)
+    translated.time = next(it)
+    translated.calories = next(it)
+    for ing in translated.ingredients:
+        ing.name, ing.amount, ing.unit = next(it), next(it), next(it)
+    for step in translated.steps:
+        step.description = next(it)
+        for ing in step.ingredients:
+            ing.name, ing.amount, ing.unit = next(it), next(it), next(it)
+    return translated
+
+def _apply_translation(recipe: Recipe, strings: list[str], unique: tuple[str, ...], translated, language: str) -> Recipe:
+    lookup = dict(zip(unique, translated))
+    translated_recipe = _with_translated_strings(recipe, [lookup.get(s, s) for s in strings])
+    translated_recipe.language = language
+    return translated_recipe
+
+def _request_translation(strings: tuple[str, ...], target_language: str) -> tuple[str, ...]:
+    """
+    Translates a tuple of strings with a Gemini call of its own, returning them in the same order.
     """
+    prompt = _TRANSLATE_PROMPT.format(language=target_language, count=len(strings), strings=orjson.dumps(strings).decode())
     
+    response = _call_with_retries(
+        client.models.generate_content,
+        model="gemini-2.0-flash", # Use faster model for translation
+        contents=prompt,
+        config=_TRANSLATE_CONFIG
+    )
+    translated = response.parsed
+    if not isinstance(translated, list) or len(translated) != len(strings):
+        raise ValueError(f"Translation returned {len(translated) if isinstance(translated, list) else 'no'} strings, expected {len(strings)}")
+    return tuple(str(t) for t in translated)
+
+def _resolve(future: Future, fn, *args):
     try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash", # Use faster model for translation
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json"
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+
+class _TranslationBatcher:
+    """
+    Collects translation jobs from every thread and sends the ones arriving together in one Gemini call.
+    A job arriving while no batch is being sent goes out right away, so a lone translation doesn't wait.
+    Under load a background thread flushes a batch after the window or once it holds max_jobs.
+    """
+    def __init__(self, window: float, max_jobs: int):
+        self._window = window
+        self._max_jobs = max_jobs
+        self._pending = [] # (strings, language, future)
+        self._in_flight = 0 # batches handed to the senders and not answered yet
+        self._cond = threading.Condition()
+        self._thread = None
+        # Batches are sent from a pool so a slow call doesn't hold up collecting the next one
+        self._senders = ThreadPoolExecutor(max_workers=4, thread_name_prefix="translation-batches")
+
+    def submit(self, strings: tuple[str, ...], language: str) -> Future:
+        future = Future()
+        with self._cond:
+            self._pending.append((strings, language, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="translation-batcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # Nothing being sent means no load to batch with, only wait while calls are in flight
+                deadline = time.monotonic() + (self._window if self._in_flight else 0)
+                while len(self._pending) < self._max_jobs:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self._max_jobs]
+                self._pending = self._pending[self._max_jobs:]
+                self._in_flight += 1
+            self._senders.submit(self._send_batch, batch)
+
+    def _send_batch(self, batch: list):
+        try:
+            self._send(batch)
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+
+    def _send(self, batch: list):
+        if len(batch) == 1:
+            strings, language, future = batch[0]
+            _resolve(future, _request_translation, strings, language)
+            return
+
+        logger.info("Translating %d jobs in one batch", len(batch))
+        results = []
+        try:
+            jobs = [{"language": language, "strings": strings} for strings, language, _ in batch]
+            response = _call_with_retries(
+                client.models.generate_content,
+                model="gemini-2.0-flash", # Use faster model for translation
+                contents=_TRANSLATE_BATCH_PROMPT.format(jobs=orjson.dumps(jobs).decode()),
+                config=_TRANSLATE_BATCH_CONFIG
             )
-        )
-        text_response = response.text.replace("```json", "").replace("```", "").strip()
-        data = json.loads(text_response)
-        
-        # Handle case where Gemini returns a list instead of a dict
-        if isinstance(data, list):
-            if len(data) > 0 and isinstance(data[0], dict):
-                data = data[0]
+            results = response.parsed
+            if not isinstance(results, list):
+                raise ValueError("Batch translation did not return a JSON array")
+        except Exception as e:
+            logger.warning("Batch translation failed, translating jobs separately: %s", e)
+
+        for i, (strings, language, future) in enumerate(batch):
+            translated = results[i] if i < len(results) else None
+            if isinstance(translated, list) and len(translated) == len(strings):
+                future.set_result(tuple(str(t) for t in translated))
             else:
-                # Try to find a dict in the list that looks like a recipe? 
-                # Or just error out gracefully
-                print("Translation returned a list without a valid dict")
-                return recipe
-
-        # Preserve original images/metadata
-        translated_recipe = Recipe(**data)
-        translated_recipe.id = recipe.id
-        translated_recipe.source_url = recipe.source_url
-        translated_recipe.hero_image_url = recipe.hero_image_url
-        translated_recipe.language = target_language
-        translated_recipe.steps = [
-            Step(description=s.description, image_url=orig_s.image_url, ingredients=s.ingredients) 
-            for s, orig_s in zip(translated_recipe.steps, recipe.steps)
-        ]
-        
-        return translated_recipe
+                # Missing or malformed in the batch answer, ask for this one on its own
+                _resolve(future, _request_translation, strings, language)
+
+_translation_batcher = _TranslationBatcher(TRANSLATION_BATCH_WINDOW, TRANSLATION_BATCH_MAX_JOBS)
+
+@lru_cache(maxsize=TRANSLATION_CACHE_SIZE)
+def _translate_strings(strings: tuple[str, ...], target_language: str) -> tuple[str, ...]:
+    """
+    Translates a tuple of strings with Gemini, returning them in the same order.
+    Memoized per process, errors raise so failed translations are not cached.
+    """
+    if TRANSLATION_BATCH_WINDOW <= 0:
+        return _request_translation(strings, target_language)
+    return _translation_batcher.submit(strings, target_language).result()
+
+def translate_recipe(recipe: Recipe, target_language: str) -> Recipe:
+    logger.info("Translating recipe to %s...", target_language)
+    # Only the text is sent, as a flat list of unique strings: no JSON scaffolding, IDs or image URLs
+    strings = _translatable_strings(recipe)
+    unique = tuple(dict.fromkeys(s for s in strings if s))
+    
+    try:
+        return _apply_translation(recipe, strings, unique, _translate_strings(unique, target_language), target_language)
     except Exception as e:
-        print(f"Translation failed: {e}")
+        logger.warning("Translation failed: %s", e)
         return recipe # Fallback to original
 
-def analyze_video(video_path: str | None, video_url: str, language: str = "en", author_name: str | None = None) -> Recipe:
+def translate_recipe_multi(recipe: Recipe, target_languages: list[str]) -> dict[str, Recipe]:
     """
-    Uploads a video to Gemini and analyzes it to extract a recipe.
-    Handles caching and translation.
+    Translates a recipe into several languages with a single Gemini call.
+    Languages missing or malformed in the response fall back to translate_recipe.
     """
-    
-    # 1. Check if recipe exists in Firestore
-    existing_data = get_recipe_from_firestore(video_url)
-    if existing_data:
-        # Check if requested language exists in translations
-        translations = existing_data.get('translations', {})
-        if language in translations:
-            print(f"Returning cached recipe for language: {language}")
-            cached_recipe = Recipe(**translations[language])
-            cached_recipe.id = generate_recipe_id(video_url)
-            # Use global rating if available
-            if 'rating' in existing_data:
-                cached_recipe.rating = float(existing_data['rating'])
-            if 'reviews_count' in existing_data:
-                cached_recipe.reviews_count = int(existing_data['reviews_count'])
-            cached_recipe.source_url = video_url
-            cached_recipe.language = language
-            # Restore hero image if not in translation but in main doc
-            if not cached_recipe.hero_image_url and existing_data.get('hero_image_url'):
-                cached_recipe.hero_image_url = existing_data.get('hero_image_url')
-            return cached_recipe
-        
-        # If language not found, but we have English (or another base), use it as base for translation
-        # Typically the 'base' recipe might not be stored separately if we only use translations map.
-        # But our save logic puts 'translations' map. 
-        # We can pick 'en' or any available language to translate FROM.
-        base_lang = 'en'
-        if base_lang in translations:
-            print(f"Found base recipe in {base_lang}, translating to {language}...")
-            base_recipe = Recipe(**translations[base_lang])
-            base_recipe.id = generate_recipe_id(video_url)
-            # Use global rating if available
-            if 'rating' in existing_data:
-                base_recipe.rating = float(existing_data['rating'])
-            if 'reviews_count' in existing_data:
-                base_recipe.reviews_count = int(existing_data['reviews_count'])
-            base_recipe.source_url = video_url
-            
-            translated = translate_recipe(base_recipe, language)
-            save_recipe_to_firestore(translated.dict(), video_url, language)
-            translated.id = base_recipe.id
-            return translated
-            
-    # If we are here, we need to process the video.
-    if not video_path:
-        # If no video path and no cache, we can't do anything
-        raise ValueError("Video path is required for new analysis.")
+    languages = list(dict.fromkeys(target_languages))
+    if len(languages) <= 1:
+        return {lang: translate_recipe(recipe, lang) for lang in languages}
 
-    # 3. Analyze video
-    print(f"Uploading file: {video_path}")
-    video_file = client.files.upload(file=video_path)
-    print(f"Completed upload: {video_file.name}")
+    logger.info("Translating recipe to %s...", ", ".join(languages))
+    strings = _translatable_strings(recipe)
+    unique = tuple(dict.fromkeys(s for s in strings if s))
+    prompt = _TRANSLATE_MULTI_PROMPT.format(languages=", ".join(languages), count=len(unique), strings=orjson.dumps(unique).decode())
 
-    # Wait for processing
+    results = {}
+    try:
+        response = _call_with_retries(
+            client.models.generate_content,
+            model="gemini-2.0-flash", # Use faster model for translation
+            contents=prompt,
+            config=_TRANSLATE_MULTI_CONFIG
+        )
+        translated = {item["language"]: item["strings"] for item in response.parsed or []}
+        for lang in languages:
+            values = translated.get(lang)
+            if isinstance(values, list) and len(values) == len(unique):
+                results[lang] = _apply_translation(recipe, strings, unique, [str(v) for v in values], lang)
+    except Exception as e:
+        logger.warning("Batch translation failed: %s", e)
+
+    for lang in languages:
+        if lang not in results:
+            results[lang] = translate_recipe(recipe, lang)
+    return results
+
+def _wait_for_file_active(video_file):
+    """
+    Polls an uploaded Gemini file until it leaves the PROCESSING state.
+    Uses exponential backoff so short videos are picked up quickly.
+    A transient error on a status check restarts the backoff, only repeated failures abort.
+    """
+    delay = FILE_POLL_INITIAL_DELAY
+    elapsed = 0.0
+    consecutive_failures = 0
     while video_file.state == "PROCESSING":
-        print('.', end='', flush=True)
-        time.sleep(2)
-        video_file = client.files.get(name=video_file.name)
+        if elapsed >= FILE_PROCESSING_MAX_WAIT:
+            raise ValueError(f"Video processing timed out after {elapsed:.0f}s.")
+        logger.debug("Waiting for Gemini file %s, state=%s", video_file.name, video_file.state)
+        # A little jitter so uploads that finished together don't poll in lockstep
+        sleep_for = delay + random.uniform(0, FILE_POLL_JITTER)
+        time.sleep(sleep_for)
+        elapsed += sleep_for
+        try:
+            video_file = client.files.get(name=video_file.name)
+        except Exception as e:
+            consecutive_failures += 1
+            if consecutive_failures >= FILE_POLL_MAX_FAILURES:
+                raise ValueError(f"Video status check failed {consecutive_failures} times: {e}")
+            logger.warning("Video status check failed (%d/%d): %s", consecutive_failures, FILE_POLL_MAX_FAILURES, e)
+            delay = FILE_POLL_INITIAL_DELAY
+            continue
+        consecutive_failures = 0
+        delay = min(delay * FILE_POLL_BACKOFF, FILE_POLL_MAX_DELAY)
 
     if video_file.state == "FAILED":
         raise ValueError("Video processing failed.")
+    return video_file
 
-    print(f"\nFile is ready: {video_file.name}")
+# Deletes of uploaded files nobody will reuse run on one background thread, off the request path
+_FILE_REAPER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gemini-file-reaper")
 
-    prompt = """
-    Analyze this video and extract the recipe.
-    Return the result in JSON format with the following structure:
-    {
-        "title": "Recipe Title",
-        "description": "Short description (max 2 sentences)",
-        "category": "Category (e.g., Breakfast, Lunch, Dinner, Dessert, Snack)",
-        "time": "Total cooking time (e.g., 25 min)",
-        "difficulty": "Difficulty level (Easy, Medium, Hard)",
-        "calories": "Estimated calories per serving (e.g., 450)",
-        "ingredients": [
-            {"name": "Ingredient Name", "amount": "Amount", "unit": "Unit"}
-        ],
-        "steps": [
-            {
-                "description": "Step 1 description",
-                "ingredients": [
-                    {"name": "Ingredient Name", "amount": "Amount", "unit": "Unit"}
-                ]
-            },
-            {
-                "description": "Step 2 description",
-                 "ingredients": []
-            }
-        ]
-    }
-    Ensure the output is valid JSON. Do not include markdown code blocks.
-    Response MUST be in English.
+# In-process layer over the geminiFiles collection: content hash -> (active file, expiry timestamp).
+# A file stays ACTIVE until Gemini expires it, so a local hit needs neither Firestore nor files.get.
+_LOCAL_GEMINI_FILES = {}
+
+def _remember_file(video_hash: str, video_file):
+    if video_file.expiration_time:
+        # Stop an hour early, same margin as GEMINI_FILE_TTL
+        expires_at = video_file.expiration_time.timestamp() - 3600
+    else:
+        expires_at = time.time() + GEMINI_FILE_TTL
+    _LOCAL_GEMINI_FILES[video_hash] = (video_file, expires_at)
+
+def _get_reusable_file(video_hash: str):
+    """
+    Returns a still-active Gemini file previously uploaded for the same video content, if any.
     """
+    local = _LOCAL_GEMINI_FILES.get(video_hash)
+    if local:
+        video_file, expires_at = local
+        if expires_at > time.time():
+            return video_file
+        _LOCAL_GEMINI_FILES.pop(video_hash, None)
 
+    file_name = get_gemini_file(video_hash)
+    if not file_name:
+        return None
     try:
-        # Generate content
-        response = client.models.generate_content(
-            model="gemini-3-flash-preview",
-            contents=[video_file, prompt],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json"
+        video_file = client.files.get(name=file_name)
+    except errors.ClientError as e:
+        # 404 once Gemini has expired the file
+        logger.info("Cached Gemini file %s is no longer available: %s", file_name, e)
+        return None
+    except (errors.APIError, httpx.TransportError) as e:
+        # Only a reuse lookup, a fresh upload still works
+        logger.warning("Could not check cached Gemini file %s, uploading again: %s", file_name, e)
+        return None
+    if video_file.state != "ACTIVE":
+        return None
+    _remember_file(video_hash, video_file)
+    return video_file
+
+class _StepStreamParser:
+    """
+    Scans the recipe JSON while it streams in and reports every step as soon as its object is complete.
+    Only tracks nesting and strings, the final document is still parsed as a whole at the end.
+    """
+    def __init__(self, on_step):
+        self.on_step = on_step
+        self.buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._steps_key_pos = None
+        self._in_steps = False
+        self._step_start = None
+        self._step_count = 0
+        self._header = None
+
+    @property
+    def steps_emitted(self) -> int:
+        """
+        Number of complete steps seen in the stream so far, including any that failed to parse.
+        """
+        return self._step_count
+
+    def feed(self, text: str):
+        self.buffer += text
+        buf = self.buffer
+        while self._pos < len(buf):
+            i = self._pos
+            c = buf[i]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    self._last_string = buf[self._string_start + 1:i]
+                    if self._depth == 1 and self._last_string == "steps":
+                        self._steps_key_pos = self._string_start
+                continue
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in "{[":
+                if c == "[" and self._depth == 1 and self._last_string == "steps" and self._steps_key_pos is not None:
+                    self._in_steps = True
+                elif c == "{" and self._in_steps and self._depth == 2:
+                    self._step_start = i
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if c == "}" and self._in_steps and self._depth == 2 and self._step_start is not None:
+                    self._emit_step(buf[self._step_start:i + 1])
+                    self._step_start = None
+                elif c == "]" and self._in_steps and self._depth == 1:
+                    self._in_steps = False
+
+    def header(self) -> dict:
+        """
+        Top-level fields emitted before "steps" (title, description, ...).
+        """
+        if self._header is None:
+            try:
+                prefix = self.buffer[self.buffer.index("{"):self._steps_key_pos].rstrip().rstrip(",")
+                self._header = orjson.loads(prefix + "}")
+            except Exception:
+                self._header = {}
+        return self._header
+
+    def _emit_step(self, raw: str):
+        try:
+            step = orjson.loads(raw)
+        except Exception as e:
+            logger.warning("Could not parse streamed step %d: %s", self._step_count, e)
+            step = None
+        if step is not None:
+            try:
+                self.on_step(self._step_count, step, self.header())
+            except Exception as e:
+                logger.warning("Streamed step handler failed: %s", e)
+        self._step_count += 1
+
+def _video_hash(video_data: bytes) -> str:
+    return blake3(video_data, max_threads=blake3.AUTO).hexdigest()
+
+def _delete_file(file_name: str):
+    try:
+        client.files.delete(name=file_name)
+        logger.info("Deleted Gemini file %s", file_name)
+    except Exception as e:
+        logger.warning("Failed to delete Gemini file %s: %s", file_name, e)
+
+def _delete_file_later(file_name: str):
+    # Nobody waits on the delete, hand it to the reaper thread
+    _FILE_REAPER.submit(_delete_file, file_name)
+
+def _extract_recipe_with_images(video_file, prompt: str) -> tuple[dict, list[bytes]]:
+    """
+    Asks the image model for the recipe JSON and the step images in a single call.
+    Returns the parsed recipe and the images in the order they were emitted.
+    """
+    response = _call_with_retries(
+        client.models.generate_content,
+        model=IMAGE_MODEL,
+        contents=[video_file, prompt + _FUSED_IMAGES_PROMPT],
+        config=types.GenerateContentConfig(
+            response_modalities=['TEXT', 'IMAGE'],
+            image_config=types.ImageConfig(
+                aspect_ratio="9:16"
             )
         )
+    )
+
+    text_parts = []
+    images = []
+    for part in response.parts or []:
+        if part.inline_data:
+            images.append(part.inline_data.data)
+        elif part.text and not part.thought:
+            text_parts.append(part.text)
+
+    return _parse_json_response("".join(text_parts)), images
+
+def _prepare_video_file(video_data: bytes, video_hash: str):
+    """
+    Returns an ACTIVE Gemini file for the video, and whether it is registered for reuse.
+    Uploads are keyed by content hash and reused while Gemini still retains the file.
+    """
+    video_file = _get_reusable_file(video_hash)
+    reused = video_file is not None
+    if reused:
+        logger.info("Reusing Gemini file %s for video %s", video_file.name, video_hash)
+    else:
+        logger.info("Uploading %d bytes of video", len(video_data))
+        # Upload straight from memory, the video never hits local disk
+        video_file = client.files.upload(
+            file=io.BytesIO(video_data),
+            config=types.UploadFileConfig(mime_type=VIDEO_MIME_TYPE)
+        )
+        logger.info("Completed upload: %s", video_file.name)
+
+        try:
+            video_file = _wait_for_file_active(video_file)
+        except Exception:
+            # Never became usable, don't leave it counting against the project storage quota
+            _delete_file_later(video_file.name)
+            raise
+        logger.info("File is ready: %s", video_file.name)
+        reused = save_gemini_file(video_hash, video_file.name, GEMINI_FILE_TTL)
+        if reused:
+            _remember_file(video_hash, video_file)
+    return video_file, reused
+
+def _release_unused_file(future: Future):
+    # Done callback for a Gemini file prepared ahead of time that ended up not being needed
+    if future.cancelled() or future.exception():
+        return
+    video_file, reused = future.result()
+    if not reused:
+        _delete_file_later(video_file.name)
+
+def _extract_recipe_data(video_data: bytes, video_hash: str | None = None, on_step=None, on_step_image=None, video_file_future: Future | None = None) -> dict:
+    """
+    Uploads a video to Gemini and returns the raw recipe JSON extracted from it.
+    Pass video_file_future (from _prepare_video_file) when the upload was already started.
+    The response is streamed, on_step(index, step, header) is called for each step as soon as it is complete.
+    With FUSED_STEP_IMAGES, on_step_image(index, step, image_bytes) receives the images generated in the same call.
+    """
+    video_hash = video_hash or _video_hash(video_data)
+    if video_file_future:
+        video_file, reused = video_file_future.result()
+    else:
+        video_file, reused = _prepare_video_file(video_data, video_hash)
+
+    prompt = _ANALYZE_PROMPT
+
+    try:
+        if FUSED_STEP_IMAGES and on_step_image:
+            try:
+                data, images = _extract_recipe_with_images(video_file, prompt)
+                if images:
+                    # Steps without an image are generated separately afterwards
+                    for i, (step, img_data) in enumerate(zip(data.get("steps", []), images)):
+                        on_step_image(i, step, img_data)
+                    return data
+                logger.info("Fused generation returned no images, falling back to separate image calls")
+            except Exception as e:
+                logger.warning("Fused generation failed, falling back to separate image calls: %s", e)
+
+        # Generate content
+        # Streamed so step images can start while the rest of the recipe is still being generated
+        max_retries = 3
+        for attempt in range(max_retries):
+            stream_parser = _StepStreamParser(on_step) if on_step else None
+            chunks = []
+            try:
+                for chunk in client.models.generate_content_stream(
+                    model="gemini-3-flash-preview",
+                    contents=[video_file, prompt],
+                    config=_EXTRACT_CONFIG
+                ):
+                    if not chunk.text:
+                        continue
+                    chunks.append(chunk.text)
+                    if stream_parser:
+                        stream_parser.feed(chunk.text)
+                break
+            except Exception as e:
+                # Once a step went to on_step its image is queued, a second stream
+                # could word the steps differently, so only retry before that
+                steps_emitted = stream_parser is not None and stream_parser.steps_emitted > 0
+                if attempt == max_retries - 1 or steps_emitted or not _is_retryable(e):
+                    raise
+                delay = _retry_delay(e, attempt)
+                logger.warning("Recipe extraction failed (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+
+        # Schema-constrained, so the joined stream is bare JSON
+        return orjson.loads("".join(chunks))
+    except Exception as e:
+        logger.error("Error during generation: %s", e)
+        raise ValueError(f"Gemini generation failed: {e}")
+    finally:
+        # Registered files are kept for reuse and expire on Gemini's side after 48h
+        if not reused:
+            _delete_file_later(video_file.name)
+
+def _upload_step_image(i: int, step: dict, img_data: bytes, recipe_id: str, blob_name: str | None = None) -> bytes:
+    """
+    Uploads a generated step image to Firebase Storage and sets step['image_url'].
+    """
+    try:
+        # Upload straight from memory to Firebase Storage
+        remote_url = upload_image_bytes(img_data, blob_name or f"recipes/{recipe_id}/step_{int(time.time())}_{i}.png")
         
-        text_response = response.text.replace("```json", "").replace("```", "").strip()
-        data = json.loads(text_response)
-        
+        if remote_url:
+            step['image_url'] = remote_url
+            logger.info("Uploaded image for step %d", i)
+        else:
+            logger.warning("Failed to upload image for step %d", i)
+    except Exception as e:
+        logger.warning("Failed to upload image for step %d: %s", i, e)
+        step['image_url'] = None
+    return img_data
+
+def _share_uploaded_image(first_step: dict, first_upload: Future, step: dict) -> bytes:
+    # Same bytes as an image already uploaded for another step, point this step at its URL
+    img_data = first_upload.result()
+    step['image_url'] = first_step.get('image_url')
+    return img_data
+
+def _generate_step_image(i: int, step: dict, title: str | None, upload, need_bytes: bool = True) -> bytes | None:
+    """
+    Generates the image for one step and hands it to upload(i, step, img_data, blob_name), which sets step['image_url'].
+    Returns the image bytes so the hero image can use them as context.
+    Without need_bytes a cached image isn't downloaded and None is returned for it.
+    Steps don't depend on each other, so this runs concurrently for all steps.
+    """
+    img_data = None
+    try:
+        image_prompt = _STEP_IMAGE_PROMPT.format(step=step['description'], title=title)
+        contents = [image_prompt]
+
+        # Identical prompts (same dish and step) reuse the image generated the first time
+        image_key = blake3(f"{IMAGE_MODEL}:{image_prompt}".encode()).hexdigest(length=16)
+        cache_blob = f"image_cache/{image_key}.png"
+        cached = get_stored_image(cache_blob, download=need_bytes)
+        if cached:
+            step['image_url'], img_data = cached
+            logger.info("Image cache hit for step %d", i)
+            return img_data
+
+        img_data = _call_with_retries(_generate_image, contents)
+        upload(i, step, img_data, cache_blob)
+
+    except Exception as e:
+        logger.warning("Failed to process step image: %s", e)
+        step['image_url'] = None
+
+    return img_data
+
+_INFLIGHT_ANALYSES = {} # recipe_id -> (language, Future) of the analysis running in this process
+_INFLIGHT_LOCK = threading.Lock()
+
+def analyze_video(video_data: bytes | None, video_url: str, language: str = "en", author_name: str | None = None, check_cache: bool = True, generate_hero: bool | None = None, cached_analysis: dict | None = None, check_llm_cache: bool = True) -> Recipe:
+    """
+    Uploads a video to Gemini and analyzes it to extract a recipe.
+    Handles caching and translation.
+    Pass check_cache=False when the caller already looked up the Firestore document.
+    Likewise pass the get_cached_analysis result as cached_analysis, or check_llm_cache=False if it was a miss.
+    generate_hero overrides GENERATE_HERO_IMAGE for this call.
+    Concurrent calls for the same recipe in this process share one analysis.
+    """
+    # Derived from the URL, used for the Firestore document and the image paths
+    recipe_id = generate_recipe_id(video_url)
+
+    with _INFLIGHT_LOCK:
+        inflight = _INFLIGHT_ANALYSES.get(recipe_id)
+        if not inflight:
+            future = Future()
+            _INFLIGHT_ANALYSES[recipe_id] = (language, future)
+
+    if generate_hero is None:
+        generate_hero = GENERATE_HERO_IMAGE
+
+    if inflight:
+        inflight_language, inflight_future = inflight
+        logger.info("Recipe %s is already being analyzed, waiting for it", recipe_id)
+        recipe, base_recipe = inflight_future.result() # re-raises the analysis error
+        if inflight_language == language:
+            return recipe
+        if base_recipe is None:
+            # Served from Firestore, which now has what this language needs too
+            recipe, _ = _analyze_video(recipe_id, video_data, video_url, language, author_name, True, generate_hero)
+            return recipe
+        if language == "en":
+            return base_recipe
+        # Its Firestore saves are still queued, translate the English base directly instead of re-reading
+        translated = translate_recipe(base_recipe, language)
+        if translated.language == language:
+            queue_save_recipe(translated.model_dump(), video_url, language)
+        translated.id = recipe_id
+        return translated
+
+    try:
+        result = _analyze_video(recipe_id, video_data, video_url, language, author_name, check_cache, generate_hero, cached_analysis, check_llm_cache)
+        future.set_result(result)
+        return result[0]
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT_ANALYSES.pop(recipe_id, None)
+
+def _analyze_video(recipe_id: str, video_data: bytes | None, video_url: str, language: str, author_name: str | None, check_cache: bool, generate_hero: bool, cached_analysis: dict | None = None, check_llm_cache: bool = True) -> tuple[Recipe, Recipe | None]:
+    """
+    Returns the recipe in the requested language and the English base recipe it was made from.
+    The base is None when the recipe came from Firestore.
+    """
+    # 1. Check if recipe exists in Firestore (cached language, or translated from the 'en' base)
+    if check_cache:
+        cached_recipe = get_cached_recipe_from_doc(get_recipe_from_firestore(video_url), video_url, language)
+        if cached_recipe:
+            return cached_recipe, None
+            
+    # If we are here, we need to process the video.
+    # 2. Check the LLM response cache before paying for upload + inference
+
+    # Step images are generated concurrently, bounded to stay under the image model quota.
+    # With a fresh analysis they start as soon as each step streams in instead of after the whole recipe.
+    image_executor = ThreadPoolExecutor(max_workers=STEP_IMAGE_CONCURRENCY, thread_name_prefix="step-images")
+    # Uploads get their own pool so a generation slot is free for the next step while an image uploads
+    upload_executor = ThreadPoolExecutor(max_workers=STEP_IMAGE_CONCURRENCY, thread_name_prefix="image-uploads")
+    translate_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="translate")
+    step_images = {} # step index -> (step dict the image is set on, future)
+    uploads = []
+    uploaded = {} # blake3 of the image bytes -> (step dict, upload future), identical images are uploaded once
+    uploaded_lock = threading.Lock()
+
+    def queue_upload(i: int, step: dict, img_data: bytes, blob_name: str | None = None) -> Future:
+        digest = blake3(img_data).digest()
+        with uploaded_lock:
+            first = uploaded.get(digest)
+            if not first:
+                future = upload_executor.submit(_upload_step_image, i, step, img_data, recipe_id, blob_name)
+                uploaded[digest] = (step, future)
+                return future
+        logger.info("Image for step %d is identical to an uploaded one, reusing it", i)
+        return upload_executor.submit(_share_uploaded_image, *first, step)
+
+    def upload_later(i: int, step: dict, img_data: bytes, blob_name: str | None = None):
+        uploads.append(queue_upload(i, step, img_data, blob_name))
+
+    def queue_streamed_step(i: int, step: dict, header: dict):
+        step_images[i] = (step, image_executor.submit(_generate_step_image, i, step, header.get("title"), upload_later, generate_hero))
+
+    def queue_generated_image(i: int, step: dict, img_data: bytes):
+        # Copy, the step dict belongs to the raw response that goes into the LLM cache
+        step = dict(step)
+        step_images[i] = (step, queue_upload(i, step, img_data))
+
+    # Everything from here on shares one cleanup, whichever stage fails
+    try:
+        # Videos that get here are nearly always LLM cache misses: get the Gemini file ready
+        # (upload + processing) while the cache is checked instead of after it.
+        # From the worker that's only the content-hash probe, it has already checked the recipe ID.
+        # The upload pool is idle until step images exist.
+        video_file_future = None
+        if video_data:
+            video_hash = _video_hash(video_data)
+            video_file_future = upload_executor.submit(_prepare_video_file, video_data, video_hash)
+
+        # The caller may have fetched the entry already (the worker does, to decide on the download)
+        data = cached_analysis
+        if data is None and check_llm_cache:
+            data = get_llm_cache(recipe_id, PROMPT_VERSION)
+        if data:
+            logger.info("LLM cache hit for %s (prompt %s), skipping video analysis", recipe_id, PROMPT_VERSION)
+        else:
+            if not video_data:
+                # If no video and no cache, we can't do anything
+                raise ValueError("Video data is required for new analysis.")
+
+            # The same video can show up under another URL (different reel link, query string),
+            # so the analysis is also cached by the hash of the video bytes.
+            data = get_llm_cache(video_hash, PROMPT_VERSION)
+            if data:
+                logger.info("LLM cache hit for video content %s (prompt %s), skipping video analysis", video_hash, PROMPT_VERSION)
+            else:
+                # 3. Analyze video
+                # Images queued for steps that streamed in before a failure are dropped by the finally below
+                data = _extract_recipe_data(video_data, video_hash, on_step=queue_streamed_step, on_step_image=queue_generated_image, video_file_future=video_file_future)
+                video_file_future = None
+                save_llm_cache(video_hash, PROMPT_VERSION, data, LLM_CACHE_TTL)
+            # Keep the author with the cached response, cache hits skip the download that provides it
+            if author_name:
+                data["author_name"] = author_name
+            save_llm_cache(recipe_id, PROMPT_VERSION, data, LLM_CACHE_TTL)
+        if video_file_future:
+            # Cache hit after all, clean up the prepared file once it's ready without waiting for it
+            video_file_future.add_done_callback(_release_unused_file)
+
         # Add default/random values
         # Initialize rating to 0 for new recipes
         if "rating" not in data:
@@ -286,129 +1240,71 @@ def analyze_video(video_path: str | None, video_url: str, language: str = "en",
         if "author_avatar" not in data:
             data["author_avatar"] = "https://i.pravatar.cc/150?u=chef"
         
+        # Translation only needs the text, run it while the images are generated
+        translation = None
+        if language != "en":
+            translation = translate_executor.submit(translate_recipe, Recipe(**data), language)
+
         # Generate images for each step
-        print("Generating images for steps...")
-        previous_images = []
-        
+        logger.info("Generating images for steps...")
+        # Steps that streamed in during extraction are already queued, queue the rest
         for i, step in enumerate(data.get("steps", [])):
-            try:
-                image_prompt = f"Food photography, vertical 9:16 aspect ratio. Create a high quality, appetizing image for this recipe step: {step['description']}. The dish is {data.get('title')}. No text, no words, no letters."
-                
-                # Build contents with context
-                contents = []
-                for prev_img_data in previous_images:
-                    contents.append(types.Part.from_bytes(data=prev_img_data, mime_type="image/png"))
-                contents.append(image_prompt)
-
-                max_retries = 3
-                for attempt in range(max_retries):
-                    try:
-                        image_response = client.models.generate_content(
-                            model='gemini-3-pro-image-preview', 
-                            contents=contents,
-                            config=types.GenerateContentConfig(
-                                response_modalities=['IMAGE'],
-                                image_config=types.ImageConfig(
-                                    aspect_ratio="9:16",
-                                    image_size="1024x1024"
-                                )
-                            )
-                        )
-
-                        if image_response.parts:
-                            saved = False
-                            for part in image_response.parts:
-                                if part.inline_data:
-                                    img_data = part.inline_data.data
-                                    
-                                    # Store logic for next steps (limit to last 3 to save tokens/complexity if needed, or all)
-                                    # The model supports up to 14 reference images.
-                                    previous_images.append(img_data)
-                                    
-                                    # Save locally momentarily to upload
-                                    temp_filename = f"step_{int(time.time())}_{i}.png"
-                                    with open(temp_filename, "wb") as f:
-                                        f.write(img_data)
-                                    
-                                    # Upload to Firebase Storage
-                                    remote_url = upload_image(temp_filename, f"recipes/{generate_recipe_id(video_url)}/{temp_filename}")
-                                    
-                                    if remote_url:
-                                        step['image_url'] = remote_url
-                                        print(f"Uploaded image for step {i}")
-                                    else:
-                                        print(f"Failed to upload image for step {i}")
-                                    
-                                    # Cleanup local file
-                                    os.remove(temp_filename)
-                                    
-                                    saved = True
-                                    break
-                            if saved: break
-                    except Exception as e:
-                        if "503" in str(e) or "429" in str(e):
-                            if attempt < max_retries - 1:
-                                time.sleep((attempt + 1) * 2)
-                                continue
-                        print(f"Failed to generate/upload image: {e}")
-                        step['image_url'] = None
-                        break
+            if i not in step_images:
+                # Step image bytes are only needed as context for the hero image
+                step_images[i] = (step, image_executor.submit(_generate_step_image, i, step, data.get("title"), upload_later, generate_hero))
 
-            except Exception as e:
-                print(f"Failed to process step image: {e}")
-                step['image_url'] = None
+        hero_failed = False
+        if generate_hero:
+            # Gather in step order, the hero image uses the last ones as context.
+            # Their uploads keep running while the hero is generated.
+            previous_images = []
+            for i, step in enumerate(data.get("steps", [])):
+                _, future = step_images[i]
+                img_data = future.result()
+                if img_data:
+                    previous_images.append(img_data)
+            previous_images = previous_images[-HERO_CONTEXT_IMAGES:]
 
-            except Exception as e:
-                print(f"Failed to process step image: {e}")
-                step['image_url'] = None
-
-        # Generate dedicated Hero Image
-        print("Generating hero image...")
-        try:
-            hero_prompt = f"Food photography, vertical 9:16 aspect ratio. A cinematic, high-end hero shot of the final dish: {data.get('title')}. {data.get('description')}. The image should look like a professional magazine cover or cookbook photo. Make it appetizing and beautiful. No text."
+            # Generate dedicated Hero Image
+            logger.info("Generating hero image...")
+            try:
+                hero_prompt = _HERO_IMAGE_PROMPT.format(title=data.get('title'), description=data.get('description'))
             
-            # Use all previous step images as context
-            hero_contents = []
-            for prev_img_data in previous_images:
-                hero_contents.append(types.Part.from_bytes(data=prev_img_data, mime_type="image/png"))
-            hero_contents.append(hero_prompt)
+                # Use the last step images as context
+                hero_contents = []
+                for prev_img_data in previous_images:
+                    hero_contents.append(types.Part.from_bytes(data=prev_img_data, mime_type="image/png"))
+                hero_contents.append(hero_prompt)
             
-            hero_response = client.models.generate_content(
-                model='gemini-3-pro-image-preview', 
-                contents=hero_contents,
-                config=types.GenerateContentConfig(
-                    response_modalities=['IMAGE'],
-                    image_config=types.ImageConfig(
-                        aspect_ratio="9:16",
-                        image_size="1024x1024"
-                    )
-                )
-            )
+                img_data = _call_with_retries(_generate_image, hero_contents)
             
-            if hero_response.parts:
-                for part in hero_response.parts:
-                    if part.inline_data:
-                        img_data = part.inline_data.data
-                        
-                        temp_filename = f"hero_{int(time.time())}.png"
-                        with open(temp_filename, "wb") as f:
-                            f.write(img_data)
-                        
-                        remote_url = upload_image(temp_filename, f"recipes/{generate_recipe_id(video_url)}/{temp_filename}")
-                        
-                        if remote_url:
-                            data["hero_image_url"] = remote_url
-                            print("Uploaded hero image")
-                        else:
-                            print("Failed to upload hero image")
-                        
-                        os.remove(temp_filename)
-                        break
-        except Exception as e:
-            print(f"Failed to generate hero image: {e}")
-            # Fallback to first step if hero gen fails
-            if data.get("steps") and data["steps"][0].get("image_url"):
-                data["hero_image_url"] = data["steps"][0]["image_url"]
+                remote_url = upload_image_bytes(img_data, f"recipes/{recipe_id}/hero_{int(time.time())}.png")
+            
+                if remote_url:
+                    data["hero_image_url"] = remote_url
+                    logger.info("Uploaded hero image")
+                else:
+                    logger.warning("Failed to upload hero image")
+            except Exception as e:
+                logger.warning("Failed to generate hero image: %s", e)
+                hero_failed = True
+
+        # Step uploads ran alongside the hero, wait for them before using the URLs.
+        # A step queues its upload when its image is done (fused images are uploaded by the future itself),
+        # so all image futures first, then the uploads.
+        for _, future in step_images.values():
+            future.result()
+        for upload in uploads:
+            upload.result()
+        for i, step in enumerate(data.get("steps", [])):
+            streamed_step, _ = step_images[i]
+            step["image_url"] = streamed_step.get("image_url")
+
+        # Without a generated hero (disabled or failed), use the last step image: usually the plated dish
+        if not generate_hero or hero_failed:
+            step_urls = [step["image_url"] for step in data.get("steps", []) if step.get("image_url")]
+            if step_urls:
+                data["hero_image_url"] = step_urls[-1]
 
         # If no hero image generated and no step images, it will remain None or handled by frontend placeholder
 
@@ -416,28 +1312,35 @@ def analyze_video(video_path: str | None, video_url: str, language: str = "en",
         base_recipe.source_url = video_url
         base_recipe.language = "en"
         
-        # Save to Firestore (English)
-        firestore_id = save_recipe_to_firestore(base_recipe.dict(), video_url, "en")
-        base_recipe.id = firestore_id
+        # Save to Firestore (English) in the background, the ID is derived from the URL
+        queue_save_recipe(base_recipe.model_dump(), video_url, "en", PROMPT_VERSION)
+        # Fresh images and text for every language, drop what this process served before
+        forget_cached_recipe(recipe_id)
+        base_recipe.id = recipe_id
         
         # Translate if needed
-        if language != "en":
-            translated = translate_recipe(base_recipe, language)
+        if translation:
+            translated = translation.result()
+            # The translation started before the images existed, copy them over
+            translated.source_url = video_url
+            translated.hero_image_url = base_recipe.hero_image_url
+            for step, base_step in zip(translated.steps, base_recipe.steps):
+                step.image_url = base_step.image_url
             
-            # Save translated version to Firestore (merge into translations)
-            save_recipe_to_firestore(translated.dict(), video_url, language)
-            translated.id = firestore_id
-            return translated
+            # Save translated version to Firestore (merge into translations),
+            # replacing one made from an earlier analysis like the base above.
+            # A failed translation is the English recipe and isn't stored under this language.
+            if translated.language == language:
+                queue_save_recipe(translated.model_dump(), video_url, language)
+            translated.id = recipe_id
+            return translated, base_recipe
             
-        return base_recipe
+        return base_recipe, base_recipe
         
     except Exception as e:
-        print(f"Error during generation: {e}")
+        logger.error("Error during generation: %s", e)
         raise ValueError(f"Gemini generation failed: {e}")
-        
     finally:
-        try:
-             client.files.delete(name=video_file.name)
-        except Exception:
-             pass
-
+        image_executor.shutdown(wait=False, cancel_futures=True)
+        upload_executor.shutdown(wait=False, cancel_futures=True)
+        translate_executor.shutdown(wait=False)
@@ -1,33 +1,47 @@
 import requests
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# One keep-alive connection pool for every request, instead of a new connection per URL
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+MAX_PARALLEL_TESTS = 8
 
 def test_analyze_endpoint(url):
     print(f"Testing analysis for URL: {url}")
     endpoint = "http://localhost:8000/analyze"
-    
+
     try:
-        response = requests.post(endpoint, json={"url": url})
-        
+        response = _session.post(endpoint, json={"url": url})
+
         if response.status_code == 200:
-            print("\n✅ Success! Recipe extracted:")
+            print(f"\n✅ Success! Recipe extracted for {url}:")
             data = response.json()
             print(json.dumps(data, indent=2))
             return True
         else:
-            print(f"\n❌ Error: {response.status_code}")
+            print(f"\n❌ Error for {url}: {response.status_code}")
             print(response.text)
             return False
-            
+
     except requests.exceptions.ConnectionError:
         print("\n❌ Error: Could not connect to backend. Is it running?")
         print("Run: uvicorn main:app --reload")
         return False
 
 if __name__ == "__main__":
-    test_url = "https://www.instagram.com/reel/abc12345" # Replace with a real URL or pass as arg
-    
+    test_urls = ["https://www.instagram.com/reel/abc12345"] # Replace with real URLs or pass them as args
+
     if len(sys.argv) > 1:
-        test_url = sys.argv[1]
-        
-    test_analyze_endpoint(test_url)
+        test_urls = sys.argv[1:]
+
+    # Several URLs run concurrently over the shared session
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_TESTS) as executor:
+        results = list(executor.map(test_analyze_endpoint, test_urls))
+
+    if len(test_urls) > 1:
+        print(f"\n{sum(results)}/{len(test_urls)} URLs succeeded")
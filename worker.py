@@ -0,0 +1,252 @@
+import os
+import json
+import uuid
+import dramatiq
+import redis
+from dramatiq.brokers.redis import RedisBroker
+from dramatiq.brokers.stub import StubBroker
+from dramatiq.middleware import CurrentMessage
+from services.downloader import download_instagram_video
+from services.gemini import analyze_video, get_cached_recipe_from_doc, get_cached_analysis, get_cached_recipes
+from services.firebase_service import send_push_notification, add_recipe_to_user, generate_recipe_id, get_recipe_translations, flush_recipe_writes
+from models import Recipe
+
+# Broker setup
+# With REDIS_HOST set, /analyze only enqueues and the heavy lifting runs in
+# separate `dramatiq worker` processes (see Procfile).
+# Without it (local dev), a StubBroker keeps the actor importable and main.py
+# falls back to running the task in-process via FastAPI BackgroundTasks.
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+if REDIS_HOST:
+    print(f"Using Redis broker at {REDIS_HOST}")
+    broker = RedisBroker(host=REDIS_HOST, port=REDIS_PORT)
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+else:
+    print("Warning: REDIS_HOST not set, background jobs will run in the API process.")
+    broker = StubBroker()
+    redis_client = None
+
+# Lets the actor see its own message, to tell a retried attempt from the last one
+broker.add_middleware(CurrentMessage())
+dramatiq.set_broker(broker)
+
+MAX_RETRIES = 2
+JOB_TIME_LIMIT = 600 # seconds
+
+# Single-flight: only one worker processes a given reel at a time.
+# Concurrent requests for the same recipe register as waiters and get
+# notified by the winner once it finishes.
+# Outlives the actor time limit plus the failure push and fan-out that run after it fires,
+# so a job that times out still holds its own lock when it releases it.
+INFLIGHT_TTL = JOB_TIME_LIMIT + 300 # seconds
+
+# Atomically queue a waiter only while the in-flight lock is still held,
+# so nobody gets appended after the winner has drained the list.
+_queue_waiter = redis_client.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+""") if redis_client else None
+
+# Compare-and-delete: only the worker whose token is in the lock drains the waiters and releases it.
+# A worker whose lock expired and was taken over leaves both to the new holder.
+_release_lock = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    local waiters = redis.call('LRANGE', KEYS[2], 0, -1)
+    redis.call('DEL', KEYS[1], KEYS[2])
+    return waiters
+end
+return {}
+""") if redis_client else None
+
+def _acquire_inflight(recipe_id: str, waiter: dict) -> str | None:
+    """
+    Tries to become the single worker processing recipe_id.
+    Returns the lock token to release it with, or None if another worker holds it,
+    in which case the waiter was queued.
+    """
+    inflight_key = f"inflight:{recipe_id}"
+    waiters_key = f"waiters:{recipe_id}"
+    token = str(uuid.uuid4())
+    while True:
+        if redis_client.set(inflight_key, token, nx=True, ex=INFLIGHT_TTL):
+            return token
+        if _queue_waiter(keys=[inflight_key, waiters_key], args=[json.dumps(waiter), INFLIGHT_TTL]):
+            return None
+        # Lock was released between the two calls, try again
+
+def _release_inflight(recipe_id: str, token: str) -> list[dict]:
+    """
+    Releases the in-flight lock and returns the waiters queued while it was held.
+    Returns no waiters if the lock is no longer ours, its new holder notifies them.
+    """
+    raw_waiters = _release_lock(keys=[f"inflight:{recipe_id}", f"waiters:{recipe_id}"], args=[token])
+    return [json.loads(w) for w in raw_waiters]
+
+def _requeue_waiters(recipe_id: str, waiters: list[dict]):
+    """
+    Puts waiters back for the next attempt (or whichever worker processes the reel next) to notify.
+    """
+    if not waiters:
+        return
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.rpush(f"waiters:{recipe_id}", *[json.dumps(w) for w in waiters])
+    pipe.expire(f"waiters:{recipe_id}", INFLIGHT_TTL)
+    pipe.execute()
+
+def _is_final_attempt() -> bool:
+    """
+    True unless dramatiq will retry the current message if it fails.
+    """
+    message = CurrentMessage.get_current_message()
+    if message is None:
+        # Run in-process through BackgroundTasks, nothing retries it
+        return True
+    # The Retries middleware counts the retries so far in the message options
+    return message.options.get("retries", 0) >= MAX_RETRIES
+
+def _process_video(url: str, language: str) -> Recipe:
+    """
+    Downloads (if needed) and analyzes the video, returning the recipe.
+    """
+    video_data = None
+
+    # Check cache first
+    # Only the requested language and the 'en' base matter, fetch just those.
+    # A missing language is translated from the 'en' base here, no download needed.
+    doc = get_recipe_translations(url, [language, "en"])
+    cached_recipe = get_cached_recipe_from_doc(doc, url, language)
+    if cached_recipe:
+        print("Cache found, skipping download and analysis.")
+        return cached_recipe
+
+    cached_analysis = get_cached_analysis(url)
+    if not cached_analysis:
+        # 1. Download Video
+        print(f"Downloading video from: {url}")
+        video_data, metadata = download_instagram_video(url)
+        print(f"Video downloaded: {len(video_data)} bytes")
+        print(f"Metadata extracted: {metadata}")
+    else:
+        print("LLM cache found, skipping download.")
+        metadata = {}
+
+    # 2. Analyze with Gemini (this saves to Firestore internally)
+    # The document and the LLM cache entry were checked above, don't read them again
+    print("Analyzing with Gemini...")
+    return analyze_video(
+        video_data, url, language,
+        author_name=metadata.get("author_name"),
+        check_cache=False,
+        cached_analysis=cached_analysis,
+        check_llm_cache=False,
+    )
+
+def _notify_ready(recipe: Recipe, fcm_token: str | None, user_id: str | None):
+    # Recipe saves are write-behind, make sure it's persisted before the client fetches it
+    flush_recipe_writes()
+
+    # Save to User (if user_id provided)
+    if user_id and recipe and recipe.id:
+        add_recipe_to_user(user_id, recipe.id)
+
+    # Send Push Notification
+    if fcm_token and recipe:
+        send_push_notification(
+            token=fcm_token,
+            title="Recipe Ready! 🍳",
+            body=f"Your recipe '{recipe.title}' is ready to cook.",
+            data={
+                "recipe_id": recipe.id,
+                "type": "recipe_ready"
+            }
+        )
+
+def _notify_failed(fcm_token: str | None, error: Exception):
+    # Send error notification
+    if fcm_token:
+        send_push_notification(
+            token=fcm_token,
+            title="Processing Failed 😕",
+            body="We couldn't extract a recipe from that video. Please try another one.",
+            data={
+                "type": "error",
+                "error": str(error)
+            }
+        )
+
+@dramatiq.actor(max_retries=MAX_RETRIES, time_limit=JOB_TIME_LIMIT * 1000)
+def process_video_background(url: str, language: str, fcm_token: str | None, user_id: str | None):
+    """
+    Background task to process video and send push notification.
+    Failures are re-raised so dramatiq retries them, the failure push only goes out on the last attempt.
+    """
+    recipe_id = generate_recipe_id(url)
+    waiter = {"language": language, "fcm_token": fcm_token, "user_id": user_id}
+    token = None
+    if redis_client:
+        token = _acquire_inflight(recipe_id, waiter)
+        if token is None:
+            print(f"Recipe {recipe_id} is already being processed, waiting for its result.")
+            return
+
+    recipe = None
+    error = None
+    retrying = False
+    try:
+        print(f"Starting background processing for: {url}")
+        recipe = _process_video(url, language)
+        print(f"Background processing complete. Recipe ID: {recipe.id}")
+        _notify_ready(recipe, fcm_token, user_id)
+    except BaseException as e:
+        # Interrupts (TimeLimitExceeded, worker shutdown) are retried by dramatiq too
+        error = e
+        retrying = not _is_final_attempt()
+        if retrying:
+            print(f"Background processing failed, will be retried: {e!r}")
+            raise
+        print(f"Background processing failed: {e!r}")
+        _notify_failed(fcm_token, e)
+        if CurrentMessage.get_current_message() is not None or not isinstance(e, Exception):
+            # Let dramatiq record the failure, in-process runs have already notified
+            raise
+    finally:
+        # Runs for interrupts as well, so waiters are never dropped
+        waiters = _release_inflight(recipe_id, token) if redis_client else []
+        if retrying:
+            # The next attempt processes the reel again and notifies them
+            _requeue_waiters(recipe_id, waiters)
+        else:
+            _fan_out(url, language, recipe, error, waiters)
+
+def _fan_out(url: str, language: str, recipe: Recipe | None, error: BaseException | None, waiters: list[dict]):
+    """
+    Delivers the result to requests that arrived while we were processing.
+    """
+    recipes = {language: recipe}
+    other_languages = [w["language"] for w in waiters if w["language"] != language]
+    if other_languages and not error:
+        # Other languages translate from the recipe we just saved (flushed by _notify_ready),
+        # all in one call and without a download
+        try:
+            recipes.update(get_cached_recipes(url, other_languages))
+        except Exception as e:
+            print(f"Failed to translate recipe for waiters: {e}")
+
+    for w in waiters:
+        if error:
+            _notify_failed(w["fcm_token"], error)
+            continue
+        try:
+            waiter_recipe = recipes.get(w["language"])
+            if not waiter_recipe:
+                raise ValueError(f"Recipe not available in {w['language']}")
+            _notify_ready(waiter_recipe, w["fcm_token"], w["user_id"])
+        except Exception as e:
+            print(f"Failed to deliver recipe to waiter: {e}")
+            _notify_failed(w["fcm_token"], e)